@@ -1,4 +1,7 @@
+import collections
+import concurrent.futures
 import copy
+from multiprocessing import shared_memory
 import numpy as np
 
 
@@ -96,6 +99,262 @@ class UnionFind():
                     self.ranks[root2] += 1
 
 
+def _factorize_by_dict(values):
+    # factorizes values of any hashable types, keeping the caller's values as
+    # the alphabet and grouping them the same way a dictionary would
+    code_of_value = {}
+    codes = np.fromiter((code_of_value.setdefault(value, len(code_of_value))
+                         for value in values),
+                        dtype=np.int64, count=len(values))
+    alphabet = list(code_of_value)
+    try:
+        order = sorted(range(len(alphabet)), key=alphabet.__getitem__)
+    except TypeError:
+        # values that cannot be compared keep their order of first appearance
+        return alphabet, codes
+    ranks = np.empty(len(alphabet), dtype=np.int64)
+    ranks[order] = np.arange(len(alphabet))
+    return [alphabet[i] for i in order], ranks[codes]
+
+
+def _factorize_integers(values):
+    # factorizes a 1D integer (or boolean) array in O(len(values) + range of
+    # values) time with a lookup table indexed by value - minimum value, or
+    # returns None if the range of values is much larger than the number of
+    # values (for which sorting is cheaper)
+    if len(values) == 0:
+        return [], np.zeros(0, dtype=np.int64)
+    if values.dtype.kind == 'b':
+        alphabet, codes = _factorize_integers(values.view(np.uint8))
+        return [bool(value) for value in alphabet], codes
+    minimum, maximum = int(values.min()), int(values.max())
+    if maximum - minimum >= max(len(values), 2 ** 16):
+        return None
+    if values.dtype.kind == 'u':
+        offsets = values - values.dtype.type(minimum)
+    else:
+        offsets = values.astype(np.int64) - minimum
+    present = np.zeros(maximum - minimum + 1, dtype=bool)
+    present[offsets] = True
+    codes_by_offset = np.cumsum(present) - 1
+    alphabet = [minimum + offset
+                for offset in np.flatnonzero(present).tolist()]
+    return alphabet, codes_by_offset[offsets]
+
+
+def _factorize_rows(array):
+    # factorizes the rows of a 2D array as tuples: each column is factorized
+    # separately (which keeps the types of mixed-type tuples) and then the
+    # combined codes
+    column_alphabets = []
+    combined_codes = np.zeros(len(array), dtype=np.int64)
+    for column in array.T:
+        column_alphabet, column_codes = factorize(column)
+        column_alphabets.append(column_alphabet)
+        combined_codes = combined_codes * len(column_alphabet) + column_codes
+    combined_alphabet, codes = factorize(combined_codes)
+    alphabet = []
+    for combined_code in combined_alphabet:
+        value = []
+        for column_alphabet in reversed(column_alphabets):
+            combined_code, column_code = \
+                divmod(combined_code, len(column_alphabet))
+            value.append(column_alphabet[column_code])
+        alphabet.append(tuple(reversed(value)))
+    return alphabet, codes.reshape(-1)
+
+
+def factorize(values):
+    """
+    Maps a sequence of values to integer codes, so that counting can be done
+    with NumPy instead of with Python loops over the values.
+
+    Integers (and booleans) spanning a range of at most about the number of
+    values are factorized with a lookup table, in O(number of values + range
+    of values) time. Other values that NumPy holds as one numeric or string
+    type are factorized with np.unique, which sorts them, in
+    O(number of values * log(number of values)) time. Anything else (e.g., a
+    mix of types, or None) is factorized with a dictionary, so the alphabet
+    holds the caller's own values.
+
+    Input
+    -----
+    - values: list (or 1D NumPy array or some other iterable) of values; a
+        list of equal-length tuples is factorized as tuples
+
+    Outputs
+    -------
+    - alphabet: Python list of the distinct values in sorted order (as Python
+        scalars, or tuples of them), or in order of first appearance if they
+        cannot be compared with each other
+    - codes: 1D NumPy array of integers where `alphabet[codes[n]]` is the
+        n-th value
+    """
+    if isinstance(values, np.ndarray) and values.dtype.kind in 'biufUS':
+        if values.ndim == 2:
+            return _factorize_rows(values)
+        if values.dtype.kind in 'biu':
+            factorized = _factorize_integers(values)
+            if factorized is not None:
+                return factorized
+        alphabet, codes = np.unique(values, return_inverse=True)
+        return alphabet.tolist(), codes.reshape(-1)
+
+    if isinstance(values, np.ndarray) and values.ndim == 2:
+        values = [tuple(row) for row in values.tolist()]
+    else:
+        values = list(values)
+    value_types = set(map(type, values))
+    if len(value_types) == 1:
+        value_type, = value_types
+        if value_type is tuple:
+            rows = np.array(values, dtype=object)
+            if rows.ndim == 2:
+                return _factorize_rows(rows)
+        elif issubclass(value_type, (int, float, str, np.number, np.bool_)):
+            # np.asarray keeps a single scalar type as is (unless, e.g., the
+            # integers are too large for int64)
+            array = np.asarray(values)
+            if array.dtype.kind in 'biufUS':
+                return factorize(array)
+    return _factorize_by_dict(values)
+
+
+def compute_joint_counts(var1_codes, var2_codes, var1_alphabet_size,
+                         var2_alphabet_size):
+    """
+    Counts how often each pair of codes co-occurs.
+
+    Inputs
+    ------
+    - var1_codes, var2_codes: 1D NumPy arrays of integer codes (see
+        `factorize`), where the i-th entries co-occur
+    - var1_alphabet_size, var2_alphabet_size: number of possible codes for
+        each variable
+
+    Output
+    ------
+    - counts: 2D NumPy array where `counts[a, b]` is the number of times that
+        code `a` for the first variable co-occurs with code `b` for the second
+    """
+    counts = np.bincount(var1_codes * var2_alphabet_size + var2_codes,
+                         minlength=var1_alphabet_size * var2_alphabet_size)
+    return counts.reshape(var1_alphabet_size, var2_alphabet_size)
+
+
+class ArrayUnionFind():
+    def __init__(self, num_nodes):
+        """
+        Union-Find data structure for the nodes 0, 1, ..., num_nodes - 1,
+        which keeps parents and ranks in NumPy arrays and avoids recursion,
+        and which can also find and merge many nodes at once.
+
+        Input
+        -----
+        - num_nodes: number of nodes
+        """
+        self.parents = np.arange(num_nodes, dtype=np.int64)
+        self.ranks = np.zeros(num_nodes, dtype=np.int64)
+
+    def find(self, node):
+        """
+        Returns the root node of the set/connected component that a node
+        belongs to, halving the path to the root along the way (every node
+        on the path gets pointed at its grandparent).
+
+        Input
+        -----
+        - node: the node that we want to figure out which set/connected
+            component it belongs to
+
+        Output
+        ------
+        the root node for the set/connected component that `node` is in
+        """
+        parents = self.parents
+        node = int(node)
+        while parents[node] != node:
+            parents[node] = parents[parents[node]]
+            node = int(parents[node])
+        return node
+
+    def union(self, node1, node2):
+        """
+        Merges the connected components of two nodes (by rank).
+
+        Inputs
+        ------
+        - node1: first node
+        - node2: second node
+
+        Output
+        ------
+        whether the two nodes were in different connected components
+        """
+        root1 = self.find(node1)
+        root2 = self.find(node2)
+        if root1 == root2:
+            return False
+        if self.ranks[root1] > self.ranks[root2]:
+            self.parents[root2] = root1
+        else:
+            self.parents[root1] = root2
+            if self.ranks[root1] == self.ranks[root2]:
+                self.ranks[root2] += 1
+        return True
+
+    def find_many(self, nodes):
+        """
+        Vectorized `find`, which also points all of the given nodes directly
+        at their roots.
+
+        Input
+        -----
+        - nodes: 1D NumPy array of nodes
+
+        Output
+        ------
+        1D NumPy array of the root nodes of `nodes`
+        """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        roots = self.parents[nodes]
+        while True:
+            grandparents = self.parents[roots]
+            if np.array_equal(grandparents, roots):
+                break
+            roots = grandparents
+        self.parents[nodes] = roots
+        return roots
+
+    def union_many(self, nodes1, nodes2):
+        """
+        Merges the connected components of each pair (nodes1[k], nodes2[k]),
+        in order of k.
+
+        Edges whose nodes are already connected are discarded all at once
+        with `find_many`, so only the remaining edges (of which at most one
+        fewer than the number of nodes can ever merge two components) are
+        merged one at a time.
+
+        Inputs
+        ------
+        - nodes1, nodes2: 1D NumPy arrays of nodes of the same length
+
+        Output
+        ------
+        1D boolean NumPy array saying which pairs merged two different
+        connected components
+        """
+        nodes1 = np.asarray(nodes1, dtype=np.int64)
+        nodes2 = np.asarray(nodes2, dtype=np.int64)
+        merged = np.zeros(len(nodes1), dtype=bool)
+        candidates = np.flatnonzero(self.find_many(nodes1) !=
+                                    self.find_many(nodes2))
+        for k in candidates.tolist():
+            merged[k] = self.union(nodes1[k], nodes2[k])
+        return merged
+
+
 def compute_empirical_distribution(values):
     """
     Given a sequence of values, compute the empirical distribution.
@@ -113,16 +372,10 @@ def compute_empirical_distribution(values):
     # -------------------------------------------------------------------------
     # YOUR CODE HERE
     #
-    for value in values:
-        if value not in distribution:
-            distribution[value] = 1
-        else:
-            distribution[value] += 1
-    
-    total = len(values)
-    for v in distribution.keys():
-        distribution[v] /= total
-    
+    alphabet, codes = factorize(values)
+    if len(codes) > 0:
+        probabilities = np.bincount(codes) / len(codes)
+        distribution = dict(zip(alphabet, probabilities.tolist()))
 
     #
     # END OF YOUR CODE
@@ -153,17 +406,21 @@ def compute_empirical_mutual_info_nats(var1_values, var2_values):
     #
 
     empirical_mutual_info_nats = 0.0
-    
-    var1_distribution = compute_empirical_distribution(var1_values)
-    var2_distribution = compute_empirical_distribution(var2_values)
-    joint_distribution = compute_empirical_distribution(list(zip(var1_values,var2_values)))
-    
-    empirical_mutual_info_nats = 0
-    for var1 in var1_distribution:
-        for var2 in var2_distribution:
-            empirical_mutual_info_nats += joint_distribution[(var1, var2)] \
-            * np.log(joint_distribution[(var1,var2)]/(var1_distribution[var1]*var2_distribution[var2]))
-    
+
+    var1_alphabet, var1_codes = factorize(var1_values)
+    var2_alphabet, var2_codes = factorize(var2_values)
+    joint_distribution = compute_joint_counts(
+        var1_codes, var2_codes, len(var1_alphabet), len(var2_alphabet)) \
+        / len(var1_codes)
+    var1_distribution = joint_distribution.sum(axis=1)
+    var2_distribution = joint_distribution.sum(axis=0)
+
+    # pairs that never co-occur contribute 0 log 0 = 0
+    nonzero = joint_distribution > 0
+    empirical_mutual_info_nats = (joint_distribution[nonzero] * np.log(
+        joint_distribution[nonzero] /
+        np.outer(var1_distribution, var2_distribution)[nonzero])).sum()
+
     #
     # END OF YOUR CODE
     # -------------------------------------------------------------------------
@@ -171,12 +428,249 @@ def compute_empirical_mutual_info_nats(var1_values, var2_values):
     return empirical_mutual_info_nats
 
 
-def chow_liu(observations):
+def encode_columns(observations):
     """
-    Run the Chow-Liu algorithm.
+    Factorizes each column of a 2D array of observations once (see
+    `factorize`).
+
+    Input
+    -----
+    - observations: a 2D NumPy array where the i-th row corresponds to the
+        i-th training data point
+
+    Outputs
+    -------
+    - alphabets: Python list where `alphabets[j]` is the alphabet of column j
+    - codes: 2D NumPy array of integer codes with the same shape as
+        `observations`
+    """
+    num_obs, num_vars = observations.shape
+    alphabets = []
+    codes = np.empty((num_obs, num_vars), dtype=np.int64)
+    for j in range(num_vars):
+        alphabet, codes[:, j] = factorize(observations[:, j])
+        alphabets.append(alphabet)
+    return alphabets, codes
+
+
+def _one_hot(codes, alphabet_sizes, dtype):
+    # one column per (variable, value) pair, variable by variable
+    offsets = np.concatenate(([0], np.cumsum(alphabet_sizes)[:-1]))
+    one_hot = np.zeros((len(codes), int(np.sum(alphabet_sizes))), dtype=dtype)
+    one_hot[np.arange(len(codes))[:, np.newaxis], offsets + codes] = 1
+    return one_hot, offsets
+
+
+def _one_hot_dtype(num_obs):
+    # float32 sums of 0's and 1's are exact up to 2^24, and halve the memory
+    # and time of float64 products
+    return np.float32 if num_obs <= 2 ** 24 else np.float64
+
+
+def _mutual_info_row_block(codes, alphabet_sizes, blocks, row_block):
+    # empirical mutual information (in nats) between the variables of
+    # blocks[row_block] and those of each of blocks[row_block:], from the
+    # counts of co-occurring values given by products of one-hot matrices;
+    # the row block's one-hot matrix is built once for all of them
+    num_obs = len(codes)
+    dtype = _one_hot_dtype(num_obs)
+    rows = blocks[row_block]
+    row_one_hot, row_offsets = \
+        _one_hot(codes[:, rows], alphabet_sizes[rows], dtype)
+    row_marginals = row_one_hot.sum(axis=0, dtype=np.float64) / num_obs
+    results = []
+    for columns in blocks[row_block:]:
+        if columns == rows:
+            column_one_hot, column_offsets = row_one_hot, row_offsets
+        else:
+            column_one_hot, column_offsets = \
+                _one_hot(codes[:, columns], alphabet_sizes[columns], dtype)
+        results.append(_mutual_info_from_joint(
+            row_one_hot.T.dot(column_one_hot).astype(np.float64) / num_obs,
+            row_marginals,
+            column_one_hot.sum(axis=0, dtype=np.float64) / num_obs,
+            row_offsets, column_offsets))
+    return results
+
+
+def _mutual_info_from_joint(joint, row_marginals, column_marginals,
+                            row_offsets, column_offsets):
+    # mutual information (in nats) between groups of rows and groups of
+    # columns of a joint probability table, where each group of rows (or
+    # columns) holds the values of one variable and starts at one of the
+    # offsets
+    terms = np.zeros(joint.shape)
+    nonzero = joint > 0
+    # pairs of values that never co-occur contribute 0 log 0 = 0
+    terms[nonzero] = joint[nonzero] * np.log(
+        joint[nonzero] /
+        np.outer(row_marginals, column_marginals)[nonzero])
+    return np.add.reduceat(np.add.reduceat(terms, row_offsets, axis=0),
+                           column_offsets, axis=1)
+
+
+_worker_codes = None
+_worker_alphabet_sizes = None
+
+
+def _init_mutual_info_worker(codes, alphabet_sizes):
+    # each worker process receives the codes once, instead of once per block
+    global _worker_codes, _worker_alphabet_sizes
+    _worker_codes = codes
+    _worker_alphabet_sizes = alphabet_sizes
+
+
+def _mutual_info_worker_row_block(blocks, row_block):
+    return _mutual_info_row_block(_worker_codes, _worker_alphabet_sizes,
+                                  blocks, row_block)
+
+
+def compute_mutual_info_matrix(observations, num_workers=None,
+                               block_size=None):
+    """
+    Computes the empirical mutual information between every pair of
+    variables at once.
+
+    Each column is encoded once; then, for blocks of variables, the counts of
+    all pairs of values are obtained as a product of one-hot encoded blocks,
+    and the mutual information terms are summed per pair of variables. Each
+    block's one-hot matrix is built once and multiplied with those of all the
+    blocks after it (float32, when the number of observations allows exact
+    counts).
+
+    Inputs
+    ------
+    - observations: a 2D NumPy array where the i-th row corresponds to the
+        i-th training data point
+    - num_workers: if more than 1, blocks are split across a process pool
+        with this many workers
+    - block_size: number of variables per block (by default, chosen so that
+        a block's one-hot matrix takes up about 256 MB)
+
+    Output
+    ------
+    - mutual_info: a symmetric 2D NumPy array where `mutual_info[i, j]` is the
+        empirical mutual information *in nats* between variables i and j
+        (so the diagonal holds the empirical entropies)
+    """
+    alphabets, codes = encode_columns(observations)
+    num_obs, num_vars = codes.shape
+    alphabet_sizes = np.array([len(alphabet) for alphabet in alphabets],
+                              dtype=np.int64)
+    if block_size is None:
+        bytes_per_variable = \
+            np.dtype(_one_hot_dtype(num_obs)).itemsize * \
+            max(num_obs, 1) * max(alphabet_sizes.max(initial=1), 1)
+        block_size = max(1, 2 ** 28 // bytes_per_variable)
+    blocks = [slice(start, min(start + block_size, num_vars))
+              for start in range(0, num_vars, block_size)]
+
+    if num_workers is None or num_workers <= 1 or len(blocks) <= 1:
+        results = [_mutual_info_row_block(codes, alphabet_sizes, blocks,
+                                          row_block)
+                   for row_block in range(len(blocks))]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+                num_workers, initializer=_init_mutual_info_worker,
+                initargs=(codes, alphabet_sizes)) as executor:
+            futures = [executor.submit(_mutual_info_worker_row_block, blocks,
+                                       row_block)
+                       for row_block in range(len(blocks))]
+            results = [future.result() for future in futures]
+
+    mutual_info = np.zeros((num_vars, num_vars))
+    for row_block, row_results in enumerate(results):
+        rows = blocks[row_block]
+        for columns, result in zip(blocks[row_block:], row_results):
+            mutual_info[rows, columns] = result
+            mutual_info[columns, rows] = result.T
+    return mutual_info
+
+
+def maximum_spanning_tree_kruskal(weights):
+    """
+    Kruskal's algorithm for a maximum-weight spanning tree of a complete
+    graph: edges are added in order of decreasing weight unless they would
+    form a cycle, which is checked with `ArrayUnionFind`. Ties are broken in
+    favor of the edge (i, j) with the smallest i, and then the smallest j.
+
+    Input
+    -----
+    - weights: a symmetric 2D NumPy array where `weights[i, j]` is the weight
+        of edge (i, j)
+
+    Output
+    ------
+    - tree: a Python set of edges (i, j) with i < j
+    """
+    num_vars = len(weights)
+    tree = set()
+    union_find = ArrayUnionFind(num_vars)
+    rows, columns = np.triu_indices(num_vars, k=1)
+    order = np.lexsort((columns, rows, -weights[rows, columns]))
+
+    # go through the sorted edges in chunks, letting union_find drop the
+    # edges within a connected component a whole chunk at a time
+    chunk_size = max(num_vars, 1024)
+    for start in range(0, len(order), chunk_size):
+        if len(tree) == num_vars - 1:
+            break
+        chunk = order[start:start + chunk_size]
+        merged = union_find.union_many(rows[chunk], columns[chunk])
+        tree.update(zip(rows[chunk][merged].tolist(),
+                        columns[chunk][merged].tolist()))
+    return tree
+
+
+def maximum_spanning_tree_prim(weights):
+    """
+    Prim's algorithm for a maximum-weight spanning tree of a complete graph,
+    which needs O(d^2) time for d nodes and O(d) memory besides the weights,
+    without sorting the edges. The tree is grown from node 0; ties are broken
+    in favor of the node with the smallest index, and then of connecting it
+    to the node that was added to the tree first.
 
     Input
     -----
+    - weights: a symmetric 2D NumPy array where `weights[i, j]` is the weight
+        of edge (i, j)
+
+    Output
+    ------
+    - tree: a Python set of edges (i, j) with i < j
+    """
+    num_vars = len(weights)
+    tree = set()
+    if num_vars == 0:
+        return tree
+
+    # best_weights[k] is the weight of the heaviest edge from node k to the
+    # tree, namely the edge to node best_neighbors[k]
+    in_tree = np.zeros(num_vars, dtype=bool)
+    in_tree[0] = True
+    best_weights = np.array(weights[0], dtype=np.float64)
+    best_weights[0] = -np.inf
+    best_neighbors = np.zeros(num_vars, dtype=np.int64)
+    for _ in range(num_vars - 1):
+        node = int(np.argmax(best_weights))
+        neighbor = int(best_neighbors[node])
+        tree.add((min(node, neighbor), max(node, neighbor)))
+        in_tree[node] = True
+        best_weights[node] = -np.inf
+
+        heavier = (weights[node] > best_weights) & ~in_tree
+        best_weights[heavier] = weights[node][heavier]
+        best_neighbors[heavier] = node
+    return tree
+
+
+def chow_liu(observations, spanning_tree='prim', num_workers=None,
+             block_size=None):
+    """
+    Run the Chow-Liu algorithm.
+
+    Inputs
+    ------
     - observations: a 2D NumPy array where the i-th row corresponds to the
         i-th training data point
 
@@ -184,6 +678,10 @@ def chow_liu(observations):
         numbered 0, 1, ..., up to the number of variables minus 1, where the
         number of variables in the graph is determined from `observations` by
         looking at `observations.shape[1]`
+    - spanning_tree: how to find the maximum spanning tree of the mutual
+        information, either 'prim' (see `maximum_spanning_tree_prim`) or
+        'kruskal' (see `maximum_spanning_tree_kruskal`)
+    - num_workers, block_size: see `compute_mutual_info_matrix`
 
     Output
     ------
@@ -194,28 +692,25 @@ def chow_liu(observations):
     """
     best_tree = set()  # we will add in edges to this set
     num_obs, num_vars = observations.shape
-    union_find = UnionFind(range(num_vars))
 
     # -------------------------------------------------------------------------
     # YOUR CODE HERE
     #
     
     # Compute empirical mutual information for all possible node pairs
-    mutual_info_pairs = {}
-    for j in range(num_vars):
-        for i in range(j):
-            mutual_info_pairs[(i,j)] = \
-            compute_empirical_mutual_info_nats(observations[:,i], observations[:,j])
-            
-    # Sort node pairs according to their mutual information values
-    sorted_mutual_info_pairs = sorted(mutual_info_pairs, key=lambda kv: kv[1], reverse=True)
-    
-    # Add edges to the tree according to Chow-Liu algorithm
-    for (i,j) in sorted_mutual_info_pairs:
-        if union_find.find(i) != union_find.find(j):
-            union_find.union(i,j)
-            best_tree.add((i,j))
-    
+    mutual_info = compute_mutual_info_matrix(observations, num_workers,
+                                             block_size)
+
+    # Find a maximum spanning tree, with edge weights given by the mutual
+    # information
+    if spanning_tree == 'prim':
+        best_tree = maximum_spanning_tree_prim(mutual_info)
+    elif spanning_tree == 'kruskal':
+        best_tree = maximum_spanning_tree_kruskal(mutual_info)
+    else:
+        raise ValueError('Unknown spanning tree algorithm: %s'
+                         % spanning_tree)
+
     #
     # END OF YOUR CODE
     # -------------------------------------------------------------------------
@@ -223,7 +718,8 @@ def chow_liu(observations):
     return best_tree
 
 
-def compute_empirical_conditional_distribution(var1_values, var2_values):
+def compute_empirical_conditional_distribution(var1_values, var2_values,
+                                               as_arrays=False):
     """
     Given two sequences of values (corresponding to samples from two
     random variables), compute the empirical conditional distribution of
@@ -236,27 +732,45 @@ def compute_empirical_conditional_distribution(var1_values, var2_values):
     - var2_values: list (or 1D NumPy array or some other iterable) of values
         sampled from, say, $X_2$, where it is assumed that the i-th entries of
         `var1_values` and `var2_values` co-occur
+    - as_arrays: whether to return NumPy arrays instead of dictionaries
+        (see below)
+
     Output
     ------
     - conditional_distributions: a dictionary consisting of dictionaries;
         `conditional_distributions[x_2]` should be the dictionary that
         represents the conditional distribution $X_1$ given $X_2 = x_2$
+        (including values $x_1$ that never co-occur with $x_2$, with
+        probability 0)
+
+    or, if `as_arrays` is True:
+
+    - conditional_distributions: a 2D NumPy array where
+        `conditional_distributions[b, a]` is the conditional probability that
+        $X_1$ is `var1_alphabet[a]` given that $X_2$ is `var2_alphabet[b]`
+    - var1_alphabet, var2_alphabet: Python lists of the distinct values of
+        each variable in sorted order
     """
-    conditional_distributions = {x2: {} for x2 in set(var2_values)}
+    conditional_distributions = {}
 
     # -------------------------------------------------------------------------
     # YOUR CODE HERE
     #
-    
-    # Compute the empirical distribution of var2_values
-    x2_prob = compute_empirical_distribution(var2_values)
-    
-    # Compute the empirical joint distribution of var1_values and var2_values
-    joint_prob_x1_x2 = compute_empirical_distribution(list(zip(var1_values, var2_values)))
-    
-    for x2 in var2_values:
-        for x1 in var1_values:
-            conditional_distributions[x2][x1] = joint_prob_x1_x2[x1, x2]/x2_prob[x2]
+
+    # Count how often each pair of values co-occurs, with one row per value
+    # of var2_values, and normalize each row
+    var1_alphabet, var1_codes = factorize(var1_values)
+    var2_alphabet, var2_codes = factorize(var2_values)
+    joint_counts = compute_joint_counts(var2_codes, var1_codes,
+                                        len(var2_alphabet),
+                                        len(var1_alphabet))
+    conditional_table = \
+        joint_counts / joint_counts.sum(axis=1, keepdims=True)
+    if as_arrays:
+        return conditional_table, var1_alphabet, var2_alphabet
+
+    for x2, row in zip(var2_alphabet, conditional_table.tolist()):
+        conditional_distributions[x2] = dict(zip(var1_alphabet, row))
 
     #
     # END OF YOUR CODE
@@ -373,6 +887,880 @@ def learn_tree_parameters(observations, tree, root_node=0):
     return node_potentials, edge_potentials
 
 
+def read_csv_chunks(filename, chunk_size=100000, num_fields=5,
+                    skip_fields=1):
+    """
+    Reads rows of integer observations from a CSV file like `coconut.csv` a
+    chunk at a time, skipping lines without the expected number of fields.
+
+    Inputs
+    ------
+    - filename: CSV file to read
+    - chunk_size: maximum number of rows per chunk
+    - num_fields: number of comma-separated fields in a line with data
+    - skip_fields: number of leading fields that aren't observations (e.g.,
+        the date in `coconut.csv`)
+
+    Output
+    ------
+    a generator of 2D NumPy arrays, where the i-th row of each array holds
+    the observations in the i-th line of the chunk
+    """
+    rows = []
+    with open(filename, 'r') as f:
+        for line in f:
+            pieces = line.split(',')
+            if len(pieces) == num_fields:
+                rows.append([int(piece) for piece in pieces[skip_fields:]])
+                if len(rows) == chunk_size:
+                    yield np.array(rows)
+                    rows = []
+    if len(rows) > 0:
+        yield np.array(rows)
+
+
+class ChowLiuCounts():
+    def __init__(self, num_vars):
+        """
+        Sufficient statistics for Chow-Liu trees and their parameters: the
+        number of times each pair of values of each pair of variables
+        co-occurs. Observations are added a chunk at a time with `update`,
+        and counts from different shards of data can be combined with
+        `merge`, so the raw observations never have to be held in memory.
+
+        Every value seen so far for a variable gets an index into the rows
+        and columns of `counts`, in order of first appearance (so the
+        alphabets can keep growing), and `counts[a, b]` is the number of
+        observations in which the values with indices a and b co-occur.
+
+        Input
+        -----
+        - num_vars: number of variables (i.e., of columns of observations)
+        """
+        self.num_vars = num_vars
+        self.num_obs = 0
+        self.alphabets = [[] for _ in range(num_vars)]
+        self.value_indices = [{} for _ in range(num_vars)]
+        self.index_variables = []
+        self.counts = np.zeros((0, 0), dtype=np.int64)
+
+    def _indices(self, var, values):
+        # the indices of values of a variable, adding the values it hasn't
+        # seen yet
+        value_indices = self.value_indices[var]
+        for value in values:
+            if value not in value_indices:
+                value_indices[value] = len(self.index_variables)
+                self.alphabets[var].append(value)
+                self.index_variables.append(var)
+        return np.array([value_indices[value] for value in values],
+                        dtype=np.int64)
+
+    def _grow(self):
+        # makes room in `counts` for values seen for the first time
+        num_indices = len(self.index_variables)
+        if num_indices > len(self.counts):
+            counts = np.zeros((num_indices, num_indices), dtype=np.int64)
+            counts[:len(self.counts), :len(self.counts)] = self.counts
+            self.counts = counts
+
+    def update(self, observations):
+        """
+        Adds a chunk of observations to the counts.
+
+        Input
+        -----
+        - observations: a 2D NumPy array where the i-th row corresponds to
+            the i-th data point in the chunk
+        """
+        observations = np.asarray(observations)
+        if observations.ndim != 2 or observations.shape[1] != self.num_vars:
+            raise ValueError('Expected observations with %d columns'
+                             % self.num_vars)
+        num_obs = len(observations)
+        indices = np.empty(observations.shape, dtype=np.int64)
+        for var in range(self.num_vars):
+            alphabet, codes = factorize(observations[:, var])
+            indices[:, var] = self._indices(var, alphabet)[codes]
+        self._grow()
+
+        # count co-occurring values as a product of one-hot matrices, a few
+        # rows at a time so that a one-hot matrix takes up about 64 MB
+        num_indices = len(self.counts)
+        rows_per_step = max(1, 2 ** 26 // (8 * max(num_indices, 1)))
+        for start in range(0, num_obs, rows_per_step):
+            step = indices[start:start + rows_per_step]
+            one_hot = np.zeros((len(step), num_indices))
+            one_hot[np.arange(len(step))[:, np.newaxis], step] = 1.
+            self.counts += np.rint(one_hot.T.dot(one_hot)).astype(np.int64)
+        self.num_obs += num_obs
+
+    def merge(self, other):
+        """
+        Adds the counts of another `ChowLiuCounts` (e.g., computed from
+        another shard of the data) to these counts.
+
+        Input
+        -----
+        - other: `ChowLiuCounts` for the same variables
+
+        Output
+        ------
+        these counts (so that merges can be chained)
+        """
+        if other.num_vars != self.num_vars:
+            raise ValueError('Cannot merge counts for %d variables into '
+                             'counts for %d variables'
+                             % (other.num_vars, self.num_vars))
+        indices = np.empty(len(other.index_variables), dtype=np.int64)
+        for var in range(self.num_vars):
+            other_indices = [other.value_indices[var][value]
+                             for value in other.alphabets[var]]
+            indices[other_indices] = \
+                self._indices(var, other.alphabets[var])
+        self._grow()
+        self.counts[np.ix_(indices, indices)] += other.counts
+        self.num_obs += other.num_obs
+        return self
+
+    def _sorted_indices(self, var):
+        # indices of a variable's values, sorted by value
+        return [self.value_indices[var][value]
+                for value in sorted(self.alphabets[var])]
+
+    def mutual_info_matrix(self):
+        """
+        Output
+        ------
+        - mutual_info: a symmetric 2D NumPy array where `mutual_info[i, j]` is
+            the empirical mutual information *in nats* between variables i
+            and j (see `compute_mutual_info_matrix`)
+        """
+        if self.num_obs == 0:
+            return np.zeros((self.num_vars, self.num_vars))
+        # group the indices by variable
+        order = np.argsort(np.array(self.index_variables, dtype=np.int64),
+                           kind='stable')
+        alphabet_sizes = [len(alphabet) for alphabet in self.alphabets]
+        offsets = np.concatenate(([0], np.cumsum(alphabet_sizes)[:-1]))
+        joint = self.counts[np.ix_(order, order)] / self.num_obs
+        marginals = np.diag(joint)
+        return _mutual_info_from_joint(joint, marginals, marginals, offsets,
+                                       offsets)
+
+    def chow_liu(self, spanning_tree='prim'):
+        """
+        Output
+        ------
+        - best_tree: a Python set consisting of edges that are in a Chow-Liu
+            tree for the counted observations (see `chow_liu`)
+        """
+        mutual_info = self.mutual_info_matrix()
+        if spanning_tree == 'prim':
+            return maximum_spanning_tree_prim(mutual_info)
+        elif spanning_tree == 'kruskal':
+            return maximum_spanning_tree_kruskal(mutual_info)
+        raise ValueError('Unknown spanning tree algorithm: %s'
+                         % spanning_tree)
+
+    def tree_parameters(self, tree, root_node=0):
+        """
+        Maximum likelihood node and edge potentials for a tree, computed
+        from the counts in the same way that `learn_tree_parameters`
+        computes them from observations.
+
+        Inputs
+        ------
+        - tree: a set consisting of which edges are present (see
+            `learn_tree_parameters`)
+        - root_node: an integer specifying which node to treat as the root
+            node
+
+        Outputs
+        -------
+        - node_potentials, edge_potentials: see `learn_tree_parameters`
+        """
+        edges = convert_tree_as_set_to_adjacencies(tree)
+        node_potentials = {}
+        edge_potentials = {}
+
+        for node in range(self.num_vars):
+            node_potentials[node] = {
+                value: float(self.counts[index, index]) / self.num_obs
+                for value, index in zip(sorted(self.alphabets[node]),
+                                        self._sorted_indices(node))}
+
+        # conditional distributions of each node given its parent
+        fringe = [root_node]
+        visited = {node: False for node in range(self.num_vars)}
+        while len(fringe) > 0:
+            node = fringe.pop(0)
+            visited[node] = True
+            node_indices = self._sorted_indices(node)
+            for neighbor in edges.get(node, []):
+                if not visited[neighbor]:
+                    neighbor_indices = self._sorted_indices(neighbor)
+                    joint = self.counts[np.ix_(node_indices,
+                                               neighbor_indices)]
+                    conditional = joint / joint.sum(axis=1, keepdims=True)
+                    edge_potentials[(neighbor, node)] = {
+                        x_node: dict(zip(sorted(self.alphabets[neighbor]),
+                                         row))
+                        for x_node, row in zip(sorted(self.alphabets[node]),
+                                               conditional.tolist())}
+                    edge_potentials[(node, neighbor)] = {
+                        x_neighbor: dict(zip(sorted(self.alphabets[node]),
+                                             column))
+                        for x_neighbor, column
+                        in zip(sorted(self.alphabets[neighbor]),
+                               conditional.T.tolist())}
+                    fringe.append(neighbor)
+
+        return node_potentials, edge_potentials
+
+
+def _tree_parents(tree, root_node=0):
+    # (node, parent) pairs of a tree in breadth-first order from the root
+    edges = convert_tree_as_set_to_adjacencies(tree)
+    pairs = []
+    visited = {root_node}
+    fringe = collections.deque([root_node])
+    while len(fringe) > 0:
+        node = fringe.popleft()
+        for neighbor in edges.get(node, []):
+            if neighbor not in visited:
+                visited.add(neighbor)
+                pairs.append((neighbor, node))
+                fringe.append(neighbor)
+    return pairs
+
+
+def _bootstrap_replicate(codes, alphabet_sizes, seed_sequence, pseudocount,
+                         root_node):
+    # learns a Chow-Liu tree from one bootstrap resample of the rows of
+    # `codes` and returns it along with the average log likelihood of the
+    # rows left out of the resample (nan if there are none) under the
+    # tree's maximum likelihood parameters, with `pseudocount` added to
+    # every count
+    rng = np.random.default_rng(seed_sequence)
+    num_obs, num_vars = codes.shape
+    sample_rows = rng.integers(0, num_obs, size=num_obs)
+    out_of_bag = np.ones(num_obs, dtype=bool)
+    out_of_bag[sample_rows] = False
+    sample = codes[sample_rows]
+    held_out = codes[out_of_bag]
+    tree = chow_liu(sample)
+
+    # root distribution times the conditional distribution of each node
+    # given its parent, as in learn_tree_parameters
+    root_counts = np.bincount(sample[:, root_node],
+                              minlength=alphabet_sizes[root_node]) + \
+        pseudocount
+    log_likelihoods = np.log(root_counts / root_counts.sum())[
+        held_out[:, root_node]]
+    for node, parent in _tree_parents(tree, root_node):
+        joint_counts = compute_joint_counts(
+            sample[:, parent], sample[:, node], alphabet_sizes[parent],
+            alphabet_sizes[node]) + pseudocount
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_conditionals = np.log(
+                joint_counts / joint_counts.sum(axis=1, keepdims=True))
+        log_likelihoods = log_likelihoods + \
+            log_conditionals[held_out[:, parent], held_out[:, node]]
+
+    if len(held_out) == 0:
+        return tree, np.nan
+    return tree, log_likelihoods.mean()
+
+
+_bootstrap_memory = None
+_bootstrap_codes = None
+_bootstrap_settings = None
+
+
+def _init_bootstrap_worker(memory_name, shape, dtype, alphabet_sizes,
+                           pseudocount, root_node):
+    # each worker process attaches to the encoded observations in shared
+    # memory once, instead of receiving them with every replicate
+    global _bootstrap_memory, _bootstrap_codes, _bootstrap_settings
+    _bootstrap_memory = shared_memory.SharedMemory(name=memory_name)
+    _bootstrap_codes = np.ndarray(shape, dtype=dtype,
+                                  buffer=_bootstrap_memory.buf)
+    _bootstrap_settings = (alphabet_sizes, pseudocount, root_node)
+
+
+def _bootstrap_worker_replicate(seed_sequence):
+    alphabet_sizes, pseudocount, root_node = _bootstrap_settings
+    return _bootstrap_replicate(_bootstrap_codes, alphabet_sizes,
+                                seed_sequence, pseudocount, root_node)
+
+
+def bootstrap_chow_liu(observations, num_replicates=100, num_workers=None,
+                       random_seed=None, pseudocount=1., root_node=0):
+    """
+    Measures how stable the Chow-Liu tree is by learning one from each of a
+    number of bootstrap resamples of the observations (rows drawn with
+    replacement), and how well each learned model generalizes by scoring the
+    rows that its resample left out.
+
+    Each replicate gets its own random generator spawned from `random_seed`,
+    so the results don't depend on how the replicates are split across
+    workers. With a process pool, the encoded observations are placed in
+    shared memory, which each worker attaches to once.
+
+    Inputs
+    ------
+    - observations: a 2D NumPy array where the i-th row corresponds to the
+        i-th data point (see chow_liu())
+    - num_replicates: number of bootstrap resamples
+    - num_workers: if more than 1, the replicates are split across a process
+        pool with this many workers
+    - random_seed: seed for the resampling (None for a fresh one)
+    - pseudocount: added to every count when estimating the parameters used
+        to score left-out rows, so that values or pairs of values a resample
+        happened to miss don't get probability 0
+    - root_node: the root node for the parameters (see
+        learn_tree_parameters())
+
+    Output
+    ------
+    - results: Python dictionary with
+        - 'trees': list of the Chow-Liu trees learned from each resample
+        - 'edge_frequencies': symmetric 2D NumPy array where
+            `edge_frequencies[i, j]` is the fraction of the trees that have
+            edge (i, j)
+        - 'consensus_tree': maximum spanning tree of the edge frequencies
+        - 'held_out_log_likelihoods': 1D NumPy array with the average log
+            likelihood of the rows left out of each resample (nan for a
+            resample that left out no rows)
+    """
+    alphabets, codes = encode_columns(observations)
+    alphabet_sizes = np.array([len(alphabet) for alphabet in alphabets],
+                              dtype=np.int64)
+    num_vars = codes.shape[1]
+    seed_sequences = np.random.SeedSequence(random_seed).spawn(num_replicates)
+
+    if num_workers is None or num_workers <= 1 or num_replicates <= 1:
+        results = [_bootstrap_replicate(codes, alphabet_sizes, seed_sequence,
+                                        pseudocount, root_node)
+                   for seed_sequence in seed_sequences]
+    else:
+        memory = shared_memory.SharedMemory(create=True,
+                                            size=max(codes.nbytes, 1))
+        try:
+            shared_codes = np.ndarray(codes.shape, dtype=codes.dtype,
+                                      buffer=memory.buf)
+            shared_codes[:] = codes
+            with concurrent.futures.ProcessPoolExecutor(
+                    num_workers, initializer=_init_bootstrap_worker,
+                    initargs=(memory.name, codes.shape, codes.dtype.str,
+                              alphabet_sizes, pseudocount,
+                              root_node)) as executor:
+                results = list(executor.map(
+                    _bootstrap_worker_replicate, seed_sequences,
+                    chunksize=max(1, num_replicates // (4 * num_workers))))
+            del shared_codes
+        finally:
+            memory.close()
+            memory.unlink()
+
+    trees = [tree for tree, _ in results]
+    edge_frequencies = np.zeros((num_vars, num_vars))
+    for tree in trees:
+        for i, j in tree:
+            edge_frequencies[i, j] += 1
+            edge_frequencies[j, i] += 1
+    edge_frequencies /= max(num_replicates, 1)
+    return {'trees': trees,
+            'edge_frequencies': edge_frequencies,
+            'consensus_tree': maximum_spanning_tree_prim(edge_frequencies),
+            'held_out_log_likelihoods':
+                np.array([log_likelihood for _, log_likelihood in results])}
+
+
+class CompiledTree():
+    def __init__(self, nodes, edges, node_potentials, edge_potentials):
+        """
+        A tree graphical model compiled for running Sum-Product with NumPy:
+        potentials become arrays, with each node's values numbered in the
+        order of the keys of its node potential, and message passing
+        follows a breadth-first schedule computed once here, so that no
+        recursion is needed however deep the tree is. (A forest works too,
+        with one breadth-first search per tree.)
+
+        Inputs
+        ------
+        - nodes, edges, node_potentials, edge_potentials: see documentation
+            for sum_product()
+        """
+        self.nodes = list(nodes)
+        self.node_indices = {node: k for k, node in enumerate(self.nodes)}
+        self.alphabets = [list(node_potentials[node]) for node in self.nodes]
+        self.value_indices = [{x: a for a, x in enumerate(alphabet)}
+                              for alphabet in self.alphabets]
+        self.node_potentials = [
+            np.array([node_potentials[node][x] for x in alphabet],
+                     dtype=np.float64)
+            for node, alphabet in zip(self.nodes, self.alphabets)]
+
+        # breadth-first schedule: order lists the nodes so that every parent
+        # comes before its children, with parents[k] = -1 for a root
+        num_nodes = len(self.nodes)
+        self.parents = np.full(num_nodes, -1, dtype=np.int64)
+        self.children = [[] for _ in range(num_nodes)]
+        order = []
+        visited = np.zeros(num_nodes, dtype=bool)
+        for root in range(num_nodes):
+            if visited[root]:
+                continue
+            visited[root] = True
+            order.append(root)
+            fringe = collections.deque([root])
+            while len(fringe) > 0:
+                k = fringe.popleft()
+                for neighbor in edges.get(self.nodes[k], []):
+                    child = self.node_indices[neighbor]
+                    if not visited[child]:
+                        visited[child] = True
+                        self.parents[child] = k
+                        self.children[k].append(child)
+                        order.append(child)
+                        fringe.append(child)
+        self.order = np.array(order, dtype=np.int64)
+
+        # edge potentials between each node and its parent, in both
+        # orientations: down_potentials[k][a, b] is the potential for the
+        # parent taking its a-th value and node k taking its b-th value, and
+        # up_potentials[k] is its transpose
+        self.down_potentials = [None] * num_nodes
+        self.up_potentials = [None] * num_nodes
+        for k in self.order[1:].tolist():
+            parent = self.parents[k]
+            if parent < 0:
+                continue
+            node, parent_node = self.nodes[k], self.nodes[parent]
+            if (parent_node, node) in edge_potentials:
+                table = edge_potentials[(parent_node, node)]
+                down = [[table[x_parent][x] for x in self.alphabets[k]]
+                        for x_parent in self.alphabets[parent]]
+            else:
+                table = edge_potentials[(node, parent_node)]
+                down = [[table[x][x_parent] for x in self.alphabets[k]]
+                        for x_parent in self.alphabets[parent]]
+            self.down_potentials[k] = np.array(down, dtype=np.float64)
+            self.up_potentials[k] = \
+                np.ascontiguousarray(self.down_potentials[k].T)
+        self._free_messages = None
+        self._log_down_potentials = None
+
+    def _sweep(self, node_potentials, touched=None, inside_all=None):
+        # one upward and one downward sweep over the schedule, with every
+        # message normalized to sum to 1 (which doesn't change the marginals,
+        # but keeps long chains from underflowing); potentials and messages
+        # are either 1D arrays or 2D arrays with one row per query, and
+        # returns (beliefs, up_messages, down_messages), where beliefs[k] is
+        # node k's potential times the messages from its children,
+        # up_messages[k] is the message from node k to its parent, and
+        # down_messages[k] is the message from its parent to node k
+        #
+        # with a batch of queries, nodes whose subtrees hold no evidence
+        # (touched[k] is False) reuse the evidence-free beliefs and upward
+        # messages, and nodes whose subtrees hold all of the evidence
+        # (inside_all[k] is True) reuse the evidence-free downward messages
+        num_nodes = len(self.nodes)
+        if touched is not None:
+            free_beliefs, free_up_messages, free_down_messages = \
+                self._evidence_free_messages()
+
+        # upward sweep
+        beliefs = list(node_potentials)
+        up_messages = [None] * num_nodes
+        for k in self.order[::-1].tolist():
+            parent = self.parents[k]
+            if touched is not None and not touched[k]:
+                beliefs[k] = free_beliefs[k]
+                up_messages[k] = free_up_messages[k]
+            elif parent >= 0:
+                message = beliefs[k].dot(self.up_potentials[k])
+                up_messages[k] = \
+                    message / message.sum(axis=-1, keepdims=True)
+            if parent >= 0 and (touched is None or touched[parent]):
+                beliefs[parent] = beliefs[parent] * up_messages[k]
+
+        # downward sweep, where a parent leaves out node k's own message by
+        # multiplying the messages of the children before and after it
+        down_messages = [None] * num_nodes
+        for k in self.order.tolist():
+            children = self.children[k]
+            if len(children) == 0:
+                continue
+            outside = node_potentials[k]
+            if down_messages[k] is not None:
+                outside = outside * down_messages[k]
+            prefixes = [outside]
+            for child in children[:-1]:
+                prefixes.append(prefixes[-1] * up_messages[child])
+            suffix = 1.
+            for child, prefix in zip(reversed(children), reversed(prefixes)):
+                if inside_all is not None and inside_all[child]:
+                    down_messages[child] = free_down_messages[child]
+                else:
+                    message = (prefix * suffix).dot(
+                        self.down_potentials[child])
+                    down_messages[child] = \
+                        message / message.sum(axis=-1, keepdims=True)
+                suffix = suffix * up_messages[child]
+
+        return beliefs, up_messages, down_messages
+
+    def _evidence_free_messages(self):
+        # the result of _sweep() on the compiled node potentials, computed
+        # once
+        if self._free_messages is None:
+            self._free_messages = self._sweep(self.node_potentials)
+        return self._free_messages
+
+    def _marginals_from_messages(self, beliefs, down_messages):
+        marginals = []
+        for k in range(len(self.nodes)):
+            marginal = beliefs[k]
+            if down_messages[k] is not None:
+                marginal = marginal * down_messages[k]
+            marginals.append(marginal / marginal.sum(axis=-1, keepdims=True))
+        return marginals
+
+    def marginals(self, node_potentials=None):
+        """
+        Runs Sum-Product as one upward and one downward sweep over the
+        schedule.
+
+        Input
+        -----
+        - node_potentials: list of 1D NumPy arrays to use instead of the
+            compiled node potentials (e.g., with observed values zeroed
+            out), in the same order as `self.nodes`
+
+        Output
+        ------
+        - marginals: list of 1D NumPy arrays where `marginals[k]` is the
+            marginal distribution of node `self.nodes[k]`, over the values
+            in `self.alphabets[k]`
+        """
+        if node_potentials is None:
+            beliefs, _, down_messages = self._evidence_free_messages()
+        else:
+            node_potentials = [np.asarray(potential, dtype=np.float64)
+                               for potential in node_potentials]
+            beliefs, _, down_messages = self._sweep(node_potentials)
+        return self._marginals_from_messages(beliefs, down_messages)
+
+    def _evidence_potentials(self, observations):
+        # node potentials for a batch of evidence assignments, where each
+        # node with evidence in any query gets one row per query (with the
+        # unobserved values zeroed out), and the number of queries with
+        # evidence at each node
+        num_queries = len(observations)
+        node_potentials = list(self.node_potentials)
+        evidence_counts = np.zeros(len(self.nodes), dtype=np.int64)
+        for q, query in enumerate(observations):
+            for node, value in query.items():
+                k = self.node_indices[node]
+                if evidence_counts[k] == 0:
+                    node_potentials[k] = np.ones((num_queries,
+                                                  len(self.alphabets[k])))
+                    node_potentials[k] *= self.node_potentials[k]
+                evidence_counts[k] += 1
+                keep = self.value_indices[k][value]
+                node_potentials[k][q, :keep] = 0.
+                node_potentials[k][q, keep + 1:] = 0.
+        return node_potentials, evidence_counts
+
+    def batch_marginals(self, observations):
+        """
+        Computes the marginals given each of a batch of Q evidence
+        assignments at once, with every message carrying one row per query.
+
+        Messages out of subtrees without any evidence are the same for
+        every query, so those are computed once per compiled tree and then
+        shared by all batches; likewise for messages into subtrees that hold
+        all of the evidence.
+
+        Input
+        -----
+        - observations: list of Q dictionaries, where each key of the q-th
+            dictionary is a node and its value is the observed value of that
+            node in the q-th query (see compute_marginals_given_observations)
+
+        Output
+        ------
+        - marginals: list of 2D NumPy arrays where `marginals[k][q]` is the
+            marginal distribution of node `self.nodes[k]` given the q-th
+            query's observations, over the values in `self.alphabets[k]`
+            (observed nodes get probability 1 at their observed values)
+        """
+        num_queries = len(observations)
+        node_potentials, evidence_counts = \
+            self._evidence_potentials(observations)
+
+        # number of nodes with evidence within each node's subtree
+        subtree_evidence = (evidence_counts > 0).astype(np.int64)
+        for k in self.order[::-1].tolist():
+            if self.parents[k] >= 0:
+                subtree_evidence[self.parents[k]] += subtree_evidence[k]
+        touched = subtree_evidence > 0
+        inside_all = subtree_evidence == np.count_nonzero(evidence_counts)
+
+        beliefs, _, down_messages = \
+            self._sweep(node_potentials, touched, inside_all)
+        return [np.broadcast_to(marginal,
+                                (num_queries, len(marginal.T))).copy()
+                for marginal in self._marginals_from_messages(
+                    beliefs, down_messages)]
+
+    def batch_map_assignments(self, observations):
+        """
+        Max-Product: finds the jointly most likely values of all nodes given
+        each of a batch of Q evidence assignments at once.
+
+        Messages are passed in log space up the schedule, from the leaves to
+        the root(s), keeping for every message which value of the sending
+        node achieves each maximum (a backpointer); the root then picks its
+        best value and the backpointers are followed back down. Subtrees
+        without evidence pass the same messages for every query, so those are
+        computed once instead of once per query. Ties go to the value that
+        comes first in the node's alphabet.
+
+        Input
+        -----
+        - observations: list of Q dictionaries of observed values (see
+            `batch_marginals`)
+
+        Outputs
+        -------
+        - assignments: 2D NumPy array where `assignments[q, k]` is the index
+            (into `self.alphabets[k]`) of node `self.nodes[k]`'s value in the
+            most likely configuration given the q-th query's observations
+        - log_scores: 1D NumPy array where `log_scores[q]` is the log of the
+            product of all potentials at that configuration
+        """
+        num_queries = len(observations)
+        num_nodes = len(self.nodes)
+        node_potentials, _ = self._evidence_potentials(observations)
+        if self._log_down_potentials is None:
+            with np.errstate(divide='ignore'):
+                self._log_down_potentials = [
+                    None if potential is None else np.log(potential)
+                    for potential in self.down_potentials]
+
+        # upward pass: scores[k] ends up as the log of node k's potential
+        # plus the log messages from its children, as a function of node k's
+        # value
+        with np.errstate(divide='ignore'):
+            scores = [np.log(potential) for potential in node_potentials]
+        backpointers = [None] * num_nodes
+        for k in self.order[::-1].tolist():
+            parent = self.parents[k]
+            if parent < 0:
+                continue
+            candidates = self._log_down_potentials[k] + \
+                scores[k][..., np.newaxis, :]
+            backpointers[k] = candidates.argmax(axis=-1)
+            scores[parent] = scores[parent] + candidates.max(axis=-1)
+
+        # downward pass: follow the backpointers from the root(s)
+        assignments = np.empty((num_queries, num_nodes), dtype=np.int64)
+        log_scores = np.zeros(num_queries)
+        queries = np.arange(num_queries)
+        for k in self.order.tolist():
+            parent = self.parents[k]
+            if parent < 0:
+                root_scores = np.broadcast_to(
+                    scores[k], (num_queries, len(self.alphabets[k])))
+                assignments[:, k] = root_scores.argmax(axis=1)
+                log_scores += root_scores.max(axis=1)
+            elif backpointers[k].ndim == 1:
+                assignments[:, k] = backpointers[k][assignments[:, parent]]
+            else:
+                assignments[:, k] = \
+                    backpointers[k][queries, assignments[:, parent]]
+        return assignments, log_scores
+
+    def map_assignment(self, observations=None):
+        """
+        Same as `batch_map_assignments` for a single query.
+
+        Input
+        -----
+        - observations: dictionary of observed values, or None for none
+
+        Outputs
+        -------
+        - assignment: Python dictionary where `assignment[i]` is the value of
+            node `i` in the most likely configuration
+        - log_score: the log of the product of all potentials at that
+            configuration
+        """
+        if observations is None:
+            observations = {}
+        assignments, log_scores = self.batch_map_assignments([observations])
+        assignment = {node: alphabet[a] for node, alphabet, a
+                      in zip(self.nodes, self.alphabets,
+                             assignments[0].tolist())}
+        return assignment, float(log_scores[0])
+
+    def marginals_dict(self, node_potentials=None):
+        """
+        Same as `marginals`, with the output in the format of sum_product().
+        """
+        return {node: dict(zip(alphabet, marginal.tolist()))
+                for node, alphabet, marginal
+                in zip(self.nodes, self.alphabets,
+                       self.marginals(node_potentials))}
+
+
+class InferenceSession():
+    def __init__(self, compiled_tree):
+        """
+        Sum-Product with evidence that changes over time: every directed
+        message of a `CompiledTree` is cached, setting or clearing evidence at
+        a node only invalidates the messages leading away from that node, and
+        messages are only recomputed when a marginal needs them. Changing the
+        evidence at one node and then asking for the marginal of another
+        node therefore costs time proportional to the path between them.
+
+        Cached messages are kept so that a message is only valid if all of
+        the messages it was computed from are; so invalidating can stop at
+        any message that is already invalid.
+
+        Input
+        -----
+        - compiled_tree: the `CompiledTree` to run inference on
+        """
+        self.tree = compiled_tree
+        num_nodes = len(compiled_tree.nodes)
+        self.node_potentials = list(compiled_tree.node_potentials)
+        self.observations = {}
+        # up_messages[k] is the message from node k to its parent and
+        # down_messages[k] the message from its parent to node k, with None
+        # for a message that needs to be (re)computed
+        self.up_messages = [None] * num_nodes
+        self.down_messages = [None] * num_nodes
+
+    def set_evidence(self, node, value):
+        """
+        Conditions on node `node` taking the value `value`.
+        """
+        if node in self.observations and self.observations[node] == value:
+            return
+        k = self.tree.node_indices[node]
+        potential = np.zeros(len(self.tree.alphabets[k]))
+        keep = self.tree.value_indices[k][value]
+        potential[keep] = self.tree.node_potentials[k][keep]
+        self.node_potentials[k] = potential
+        self.observations[node] = value
+        self._invalidate(k)
+
+    def clear_evidence(self, node):
+        """
+        Stops conditioning on the value of node `node`.
+        """
+        if node not in self.observations:
+            return
+        k = self.tree.node_indices[node]
+        self.node_potentials[k] = self.tree.node_potentials[k]
+        del self.observations[node]
+        self._invalidate(k)
+
+    def _invalidate(self, k):
+        # invalidates the messages leading away from node k: those leaving
+        # node k, then those leaving each of its neighbors except back
+        # toward node k, and so on, stopping at messages that are already
+        # invalid (everything beyond them is invalid too)
+        parents, children = self.tree.parents, self.tree.children
+        stack = [(k, -1)]
+        while len(stack) > 0:
+            j, source = stack.pop()
+            parent = parents[j]
+            if parent >= 0 and parent != source and \
+                    self.up_messages[j] is not None:
+                self.up_messages[j] = None
+                stack.append((parent, j))
+            for child in children[j]:
+                if child != source and self.down_messages[child] is not None:
+                    self.down_messages[child] = None
+                    stack.append((child, j))
+
+    def _children_product(self, k):
+        # node k's potential times the messages from all of its children
+        self._update_up_messages(self.tree.children[k])
+        product = self.node_potentials[k]
+        for child in self.tree.children[k]:
+            product = product * self.up_messages[child]
+        return product
+
+    def _update_up_messages(self, nodes):
+        # recomputes the invalid messages from the given nodes to their
+        # parents, along with the invalid messages they depend on, children
+        # before parents
+        pending = []
+        stack = [k for k in nodes if self.up_messages[k] is None]
+        while len(stack) > 0:
+            k = stack.pop()
+            pending.append(k)
+            stack.extend(child for child in self.tree.children[k]
+                         if self.up_messages[child] is None)
+        for k in reversed(pending):
+            product = self.node_potentials[k]
+            for child in self.tree.children[k]:
+                product = product * self.up_messages[child]
+            message = product.dot(self.tree.up_potentials[k])
+            self.up_messages[k] = message / message.sum()
+
+    def _update_down_message(self, k):
+        # recomputes the message from node k's parent to node k if it is
+        # invalid, along with the invalid messages on the way down to it
+        parents = self.tree.parents
+        path = []
+        while parents[k] >= 0 and self.down_messages[k] is None:
+            path.append(k)
+            k = parents[k]
+        for k in reversed(path):
+            parent = parents[k]
+            siblings = [child for child in self.tree.children[parent]
+                        if child != k]
+            self._update_up_messages(siblings)
+            outside = self.node_potentials[parent]
+            if parents[parent] >= 0:
+                outside = outside * self.down_messages[parent]
+            for sibling in siblings:
+                outside = outside * self.up_messages[sibling]
+            message = outside.dot(self.tree.down_potentials[k])
+            self.down_messages[k] = message / message.sum()
+
+    def marginal(self, node):
+        """
+        Output
+        ------
+        1D NumPy array with the marginal distribution of node `node` given
+        the current evidence, over the values in the node's alphabet (see
+        `CompiledTree`)
+        """
+        k = self.tree.node_indices[node]
+        marginal = self._children_product(k)
+        if self.tree.parents[k] >= 0:
+            self._update_down_message(k)
+            marginal = marginal * self.down_messages[k]
+        return marginal / marginal.sum()
+
+    def marginal_dict(self, node):
+        """
+        Same as `marginal`, as a dictionary like those in the output of
+        sum_product().
+        """
+        k = self.tree.node_indices[node]
+        return dict(zip(self.tree.alphabets[k], self.marginal(node).tolist()))
+
+
 def sum_product(nodes, edges, node_potentials, edge_potentials):
     """
     Run the Sum-Product algorithm.
@@ -412,75 +1800,15 @@ def sum_product(nodes, edges, node_potentials, edge_potentials):
         need to store entries that are 0
     """
     marginals = {}
-    messages = {}
 
     # -------------------------------------------------------------------------
     # YOUR CODE HERE
     #
-    
-    def send_message(j, i, grand_children_of_i):
-        """
-        Send messages from node j to node i, i.e. summing over all xj
-        
-        Input
-        -----
-        j: Source node (to be summed over)
-        i: Destination node
-        grand_children_of_i: All neighboring nodes except node i (sources of messages).
-        """
-        messages[(j,i)] = {xi: 0 for xi in node_potentials[i]}
-        
-        incoming_messages = {xj: 1 for xj in node_potentials[j]}  # Default to be 1 for leaf nodes (no effect)
-        if len(grand_children_of_i) != 0:  # Only deal with this case because at leaf node, no messages to be collected
-            for xj in node_potentials[j]:
-                for grand_child in grand_children_of_i:
-                    incoming_messages[xj] *= messages[(grand_child, j)][xj]
-        for xj in node_potentials[j]:
-            for xi in node_potentials[i]:
-                messages[(j,i)][xi] += node_potentials[j][xj] * edge_potentials[(j,i)][xj][xi] * incoming_messages[xj]
-    
-    
-    def collect_messages(j, i):
-        """
-        Collect messages from node j to node i
-        """
-        j_neighbors_except_i = [k for k in edges[j] if k != i]
-        
-        for k in j_neighbors_except_i:   # No effect when j_neighbors_except_i is empty []
-            collect_messages(k, j)
-        send_message(j, i, j_neighbors_except_i)
-        
-    def distribute_messages(i, j):
-        """
-        Distribute messages from node i to node j
-        """
-        i_neighbors_except_j = [k for k in edges[i] if k != j]
-        j_neighbors_except_i = [k for k in edges[j] if k != i]
-        
-        send_message(i, j, i_neighbors_except_j)
-        for k in j_neighbors_except_i:
-            distribute_messages(j, k)
-            
-    def compute_marginal(i):
-        marginals[i] = node_potentials[i]
-        for x in marginals[i]:
-            for neighbor_node in edges[i]:
-                marginals[i][x] *= messages[(neighbor_node, i)][x]
-                
-        # Renormalize
-        normalization_const = np.array(list(marginals[i].values())).sum()
-        for x in marginals[i]:
-            marginals[i][x] /= normalization_const
-    
-    
-    root_node = list(nodes)[0]
-    for node in edges[root_node]:
-        collect_messages(node, root_node)
-    for node in edges[root_node]:
-        distribute_messages(root_node, node)
-    for node in nodes:
-        compute_marginal(node)
-    
+
+    # compile the tree into arrays and a message passing schedule, which
+    # leaves the potentials passed in untouched
+    marginals = CompiledTree(nodes, edges, node_potentials,
+                             edge_potentials).marginals_dict()
 
     #
     # END OF YOUR CODE
@@ -603,6 +1931,59 @@ def compute_marginals_given_observations(nodes, edges, node_potentials,
                        edge_potentials)
 
 
+def compute_marginals_given_observations_batch(nodes, edges, node_potentials,
+                                               edge_potentials, observations):
+    """
+    Computes the marginals given each of a batch of observations in one pass
+    of message passing (see `CompiledTree.batch_marginals`). To answer many
+    batches with the same model, compile it once with `CompiledTree` and
+    call its `batch_marginals` instead.
+
+    Inputs
+    ------
+    - nodes, edges, node_potentials, edge_potentials: see documentation for
+        sum_product()
+    - observations: a list of Q dictionaries like the `observations` of
+        compute_marginals_given_observations()
+
+    Output
+    ------
+    - marginals: Python dictionary where `marginals[i]` is a 2D NumPy array
+        whose q-th row is the marginal distribution of node `i` given the
+        q-th observations, over the values of node `i` in the order of the
+        keys of `node_potentials[i]`
+    """
+    compiled_tree = CompiledTree(nodes, edges, node_potentials,
+                                 edge_potentials)
+    return dict(zip(compiled_tree.nodes,
+                    compiled_tree.batch_marginals(observations)))
+
+
+def max_product(nodes, edges, node_potentials, edge_potentials,
+                observations=None):
+    """
+    Run the Max-Product algorithm (see `CompiledTree.batch_map_assignments`)
+    to find the most likely configuration of all of the nodes, optionally
+    given observed values for some of them.
+
+    Inputs
+    ------
+    - nodes, edges, node_potentials, edge_potentials: see documentation for
+        sum_product()
+    - observations: a dictionary of observed values (see
+        compute_marginals_given_observations()), or None for none
+
+    Output
+    ------
+    - assignment: Python dictionary where `assignment[i]` is the value of
+        node `i` in the most likely configuration
+    """
+    compiled_tree = CompiledTree(nodes, edges, node_potentials,
+                                 edge_potentials)
+    assignment, _ = compiled_tree.map_assignment(observations)
+    return assignment
+
+
 def main():
     # get coconut oil data
     observations = []
@@ -0,0 +1,31 @@
+import numpy as np
+
+from final_proj import compute_empirical_distribution, factorize
+
+
+def test_empirical_distribution_keeps_mixed_type_values():
+    distribution = compute_empirical_distribution([1, 'a', 1])
+    assert distribution == {1: 2 / 3, 'a': 1 / 3}
+    assert [type(value) for value in sorted(distribution, key=str)] == \
+        [int, str]
+
+    distribution = compute_empirical_distribution([1, 2.5, 1])
+    assert distribution == {1: 2 / 3, 2.5: 1 / 3}
+    assert type(next(iter(distribution))) is int
+
+
+def test_empirical_distribution_with_none():
+    assert compute_empirical_distribution([None, 1, None, 2]) == \
+        {None: .5, 1: .25, 2: .25}
+    assert compute_empirical_distribution([(1, None), (1, None), (2, 3)]) \
+        == {(1, None): 2 / 3, (2, 3): 1 / 3}
+
+
+def test_factorize_homogeneous_values():
+    alphabet, codes = factorize(['b', 'a', 'b'])
+    assert alphabet == ['a', 'b']
+    assert codes.tolist() == [1, 0, 1]
+
+    alphabet, codes = factorize(np.array([3, 1, 3]))
+    assert alphabet == [1, 3]
+    assert codes.tolist() == [1, 0, 1]
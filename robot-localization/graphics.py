@@ -1,17 +1,22 @@
 # graphics.py
 # Coded by George H. Chen (georgehc@mit.edu) -- updated 10/18/2016
 import tkinter as tk
-from robot import GRID_WIDTH, GRID_HEIGHT
-import math
+import robot
+import time
+
+import numpy as np
+
+from headless import CELL_WIDTH, CELL_HEIGHT, PADDING, FRAMES_PER_SECOND, \
+    heatmap_frames
 
 
 # -----------------------------------------------------------------------------
 # Some graphics constants
 #
 
-CELL_WIDTH = 25
-CELL_HEIGHT = 25
-PADDING = 20
+# heat map fill colors, indexed by intensity
+HEATMAP_COLORS = ['#%02x%02x%02x' % (intensity, 0, 0)
+                  for intensity in range(256)]
 
 
 # -----------------------------------------------------------------------------
@@ -41,12 +46,22 @@ class playback_positions(tk.Tk):
         return vertices
 
     def __init__(self, true_positions, observed_positions,
-                 estimated_positions, estimated_marginals, *args, **kwargs):
+                 estimated_positions, estimated_marginals, *args,
+                 grid_world=None, frames_per_second=FRAMES_PER_SECOND,
+                 skip_frames=True, **kwargs):
         tk.Tk.__init__(self, *args, **kwargs)
+        # grid dimensions come from the robot.GridWorld being played back
+        if grid_world is None:
+            grid_world = robot.get_compiled_model()
+        self.grid_world = grid_world
+        self.grid_width = grid_world.width
+        self.grid_height = grid_world.height
+        map_width = self.grid_width * CELL_WIDTH
+        map_height = self.grid_height * CELL_HEIGHT
         self.wm_title('Robot Demo')
         self.canvas = tk.Canvas(self,
-                                width=GRID_WIDTH * CELL_WIDTH,
-                                height=(GRID_HEIGHT * CELL_HEIGHT +
+                                width=map_width,
+                                height=(map_height +
                                         PADDING) * 3,
                                 borderwidth=0,
                                 highlightthickness=0)
@@ -55,8 +70,8 @@ class playback_positions(tk.Tk):
         self.rect_top = {}
         self.rect_middle = {}
         self.rect_bottom = {}
-        for column in range(GRID_WIDTH):
-            for row in range(GRID_HEIGHT):
+        for column in range(self.grid_width):
+            for row in range(self.grid_height):
                 x1 = column * CELL_WIDTH
                 y1 = row * CELL_HEIGHT
                 x2 = x1 + CELL_WIDTH
@@ -67,7 +82,7 @@ class playback_positions(tk.Tk):
                                                  tags='rect_top',
                                                  outline='gray11')
 
-                y1 = row * CELL_HEIGHT + (GRID_HEIGHT * CELL_HEIGHT + PADDING)
+                y1 = row * CELL_HEIGHT + (map_height + PADDING)
                 y2 = y1 + CELL_HEIGHT
                 self.rect_middle[row, column] = \
                     self.canvas.create_rectangle(x1, y1, x2, y2,
@@ -76,7 +91,7 @@ class playback_positions(tk.Tk):
                                                  outline='gray11')
 
                 y1 = row * CELL_HEIGHT + \
-                    2 * (GRID_HEIGHT * CELL_HEIGHT + PADDING)
+                    2 * (map_height + PADDING)
                 y2 = y1 + CELL_HEIGHT
                 self.rect_bottom[row, column] = \
                     self.canvas.create_rectangle(x1, y1, x2, y2,
@@ -87,34 +102,48 @@ class playback_positions(tk.Tk):
         self.robot_top = self.canvas.create_oval(0, 0, 0, 0, fill='gray80')
         self.robot_top_arrow \
             = self.canvas.create_polygon(0, 0, 0, 0, 0, 0, 0, 0)
-        self.canvas.create_text((GRID_WIDTH * CELL_WIDTH / 2.,
-                                 GRID_HEIGHT * CELL_HEIGHT + PADDING / 3.),
+        self.canvas.create_text((map_width / 2.,
+                                 map_height + PADDING / 3.),
                                 text='True hidden state')
 
         self.robot_middle = self.canvas.create_oval(0, 0, 0, 0, fill='gray80')
         self.robot_middle_arrow \
             = self.canvas.create_polygon(0, 0, 0, 0, 0, 0, 0, 0)
-        self.canvas.create_text((GRID_WIDTH * CELL_WIDTH / 2.,
-                                 GRID_HEIGHT * CELL_HEIGHT + PADDING +
-                                 GRID_HEIGHT * CELL_HEIGHT + PADDING / 3.),
+        self.canvas.create_text((map_width / 2.,
+                                 map_height + PADDING +
+                                 map_height + PADDING / 3.),
                                 text='Observed position')
 
         self.robot_bottom = self.canvas.create_oval(0, 0, 0, 0, fill='gray80')
         self.robot_bottom_arrow \
             = self.canvas.create_polygon(0, 0, 0, 0, 0, 0, 0, 0)
-        self.canvas.create_text((GRID_WIDTH * CELL_WIDTH / 2.,
-                                 (GRID_HEIGHT * CELL_HEIGHT + PADDING) * 2 +
-                                 GRID_HEIGHT * CELL_HEIGHT + PADDING / 3.),
+        self.canvas.create_text((map_width / 2.,
+                                 (map_height + PADDING) * 2 +
+                                 map_height + PADDING / 3.),
                                 text='Estimated hidden state')
 
         # No robot or oval for the last area: just a heatmap
 
-        self.canvas.create_text((GRID_WIDTH * CELL_WIDTH / 2.,
-                                 (GRID_HEIGHT * CELL_HEIGHT + PADDING) * 3 +
-                                 GRID_HEIGHT * CELL_HEIGHT + PADDING / 3.),
+        self.canvas.create_text((map_width / 2.,
+                                 (map_height + PADDING) * 3 +
+                                 map_height + PADDING / 3.),
                                 text='Estimated position distribution')
-        self.redraw(true_positions, observed_positions, estimated_positions,
-                    estimated_marginals, 200)
+
+        # playback state: frames are drawn by index, and the bottom map only
+        # recolors cells whose heat map intensity changed since the last frame
+        # drawn (-1 means a cell's color is unknown)
+        self.true_positions = true_positions
+        self.observed_positions = observed_positions
+        self.estimated_positions = estimated_positions
+        self.heatmap_intensities, self.heatmap_present = \
+            heatmap_frames(estimated_marginals, grid_world)
+        self.displayed_intensities = \
+            np.full((self.grid_width, self.grid_height), -1, dtype=np.int16)
+        self.displayed_fills = {}
+        self.frames_per_second = frames_per_second
+        self.skip_frames = skip_frames
+        self.start_time = time.monotonic()
+        self.redraw(0)
 
     def __move_robot(self, robot, robot_arrow, state, vertical_offset=0):
         if len(state) == 2:
@@ -169,85 +198,82 @@ class playback_positions(tk.Tk):
 
     def move_robot_middle(self, state):
         self.__move_robot(self.robot_middle, self.robot_middle_arrow, state,
-                          GRID_HEIGHT * CELL_HEIGHT + PADDING)
+                          self.grid_height * CELL_HEIGHT + PADDING)
 
     def move_robot_bottom(self, state):
         self.__move_robot(self.robot_bottom, self.robot_bottom_arrow, state,
-                          2 * (GRID_HEIGHT * CELL_HEIGHT + PADDING))
+                          2 * (self.grid_height * CELL_HEIGHT + PADDING))
 
-    def redraw(self, true_positions, observed_positions, estimated_positions,
-               estimated_marginals, delay):
-        if len(true_positions) == 0:
+    def fill_map(self, tag, fill):
+        # fills all cells of one map, unless they already have that color
+        if self.displayed_fills.get(tag) != fill:
+            self.canvas.itemconfig(tag, fill=fill, outline='gray11')
+            self.displayed_fills[tag] = fill
+
+    def redraw(self, frame):
+        if frame >= len(self.true_positions):
             self.destroy()
-            # pass
+            return
+
+        if self.true_positions[frame] is not None:
+            self.fill_map('rect_top', 'black')
+            self.move_robot_top(self.true_positions[frame])
         else:
-            self.canvas.itemconfig('rect_top', fill='black',
-                                   outline='gray11')
-            self.canvas.itemconfig('rect_middle', fill='black',
-                                   outline='gray11')
-            self.canvas.itemconfig('rect_bottom', fill='black',
-                                   outline='gray11')
-
-            if true_positions[0] is not None:
-                self.move_robot_top(true_positions[0])
-            else:
-                # hide robot
-                self.move_robot_top((-10, -10))
+            # hide robot
+            self.move_robot_top((-10, -10))
 
-                # turn grid red
-                self.canvas.itemconfig('rect_top', fill='red3',
-                                       outline='gray11')
+            # turn grid red
+            self.fill_map('rect_top', 'red3')
 
-            if observed_positions[0] is not None:
-                self.move_robot_middle(observed_positions[0])
-            else:
-                # hide robot
-                self.move_robot_middle((-10, -10))
+        if self.observed_positions[frame] is not None:
+            self.fill_map('rect_middle', 'black')
+            self.move_robot_middle(self.observed_positions[frame])
+        else:
+            # hide robot
+            self.move_robot_middle((-10, -10))
 
-                # turn grid red
-                self.canvas.itemconfig('rect_middle', fill='red3',
-                                       outline='gray11')
+            # turn grid red
+            self.fill_map('rect_middle', 'red3')
 
-            if estimated_positions[0] is not None:
-                self.move_robot_bottom(estimated_positions[0])
-            else:
-                # hide robot
-                self.move_robot_bottom((-10, -10))
+        if self.estimated_positions[frame] is not None:
+            self.move_robot_bottom(self.estimated_positions[frame])
+        else:
+            # hide robot
+            self.move_robot_bottom((-10, -10))
 
+        if self.heatmap_present[frame]:
+            self.color_heatmap_grid(self.heatmap_intensities[frame])
+        else:
+            if self.estimated_positions[frame] is not None:
+                self.fill_map('rect_bottom', 'black')
+            else:
                 # turn grid red
-                self.canvas.itemconfig('rect_bottom', fill='red3',
-                                       outline='gray11')
-
-            if estimated_marginals[0] is not None:
-                self.color_heatmap_grid(estimated_marginals[0])
-
-            self.after(delay,
-                       lambda: self.redraw(true_positions[1:],
-                                           observed_positions[1:],
-                                           estimated_positions[1:],
-                                           estimated_marginals[1:],
-                                           delay))
-
-    def color_heatmap_grid(self, marginals):
+                self.fill_map('rect_bottom', 'red3')
+            self.displayed_intensities.fill(-1)
+
+        # schedule the next frame at a fixed frame rate; if drawing fell
+        # behind, skip ahead to the frame that is due
+        period = 1. / self.frames_per_second
+        next_frame = frame + 1
+        delay = period
+        if self.skip_frames:
+            elapsed = time.monotonic() - self.start_time
+            next_frame = max(next_frame, int(elapsed / period))
+            delay = next_frame * period - elapsed
+        self.after(max(int(delay * 1000), 1),
+                   lambda: self.redraw(next_frame))
+
+    def color_heatmap_grid(self, intensities):
         """
-        Color the bottom map, based on the marginal distribution.  Ignores the
-        robot's orientation (we marginalize that out).
+        Color the bottom map, given a width x height array of heat map
+        intensities (see heatmap_frames()), only recoloring the cells whose
+        intensity changed.
         """
-        position_dist = {}
-        for x in range(GRID_WIDTH):
-            for y in range(GRID_HEIGHT):
-                position_dist[x, y] = 0.0
-
-        for state, prob in marginals.items():
-            position_dist[state[0], state[1]] += prob
-
-        for x in range(GRID_WIDTH):
-            for y in range(GRID_HEIGHT):
-                # Make it easier to see the less likely states.
-                color_mapper = lambda n: math.log(max(n, 0.00000000001))
-                color = (color_mapper(position_dist[x, y]) - color_mapper(0.0)) \
-                    / (color_mapper(1.0) - color_mapper(0.0)) * 255
-                self.canvas.itemconfigure(
-                    self.rect_bottom[
-                        y, x], fill='#%02x%02x%02x' %
-                    (int(color), 0, 0))
+        self.displayed_fills.pop('rect_bottom', None)
+        changed_xs, changed_ys = \
+            np.nonzero(intensities != self.displayed_intensities)
+        for x, y in zip(changed_xs.tolist(), changed_ys.tolist()):
+            self.canvas.itemconfigure(self.rect_bottom[y, x],
+                                      fill=HEATMAP_COLORS[intensities[x, y]])
+        self.displayed_intensities[changed_xs, changed_ys] = \
+            intensities[changed_xs, changed_ys]
@@ -0,0 +1,357 @@
+# headless.py
+# Renders localization runs into NumPy RGB frames with the same layout as
+# graphics.py, without needing tkinter or a display, and writes them out as
+# NPY files, PNG sequences or (with imageio installed) animated files
+import struct
+import zlib
+
+import numpy as np
+
+import robot
+
+try:
+    import imageio
+except ImportError:
+    imageio = None
+
+
+# -----------------------------------------------------------------------------
+# Some graphics constants (shared with graphics.py)
+#
+
+CELL_WIDTH = 25
+CELL_HEIGHT = 25
+PADDING = 20
+FRAMES_PER_SECOND = 5.
+
+BACKGROUND_RGB = (217, 217, 217)
+CELL_RGB = (0, 0, 0)
+MISSING_CELL_RGB = (205, 0, 0)  # red3
+OUTLINE_RGB = (28, 28, 28)  # gray11
+ROBOT_RGB = (204, 204, 204)  # gray80
+ARROW_RGB = (0, 0, 0)
+
+
+# -----------------------------------------------------------------------------
+# Heat maps
+#
+
+HEATMAP_MIN_PROBABILITY = 0.00000000001
+
+
+def heatmap_intensities(position_probs):
+    # quantizes position probabilities (an array of any shape) into heat map
+    # intensities between 0 and 255 on a log scale, to make it easier to see
+    # the less likely positions
+    log_min = np.log(HEATMAP_MIN_PROBABILITY)
+    log_probs = np.log(np.maximum(position_probs, HEATMAP_MIN_PROBABILITY))
+    intensities = (log_probs - log_min) / (0. - log_min) * 255
+    return np.clip(intensities, 0, 255).astype(np.uint8)
+
+
+def heatmap_frames(marginals, grid_world):
+    """
+    Computes the heat map intensities of every frame in one pass, summing out
+    the robot's orientation.
+
+    Input
+    -----
+    marginals: either a 2D array with one row of marginals per time step
+        (indexed by grid_world's hidden state ids), or a list with one
+        Distribution, robot.ArrayDistribution or None (no heat map) per time
+        step
+    grid_world: the robot.GridWorld the marginals come from
+
+    Output
+    ------
+    (intensities, present), where intensities is a (number of time steps) x
+    width x height array of heat map intensities and present[t] says whether
+    there is a heat map at time step t
+    """
+    if isinstance(marginals, np.ndarray):
+        return (heatmap_intensities(grid_world.position_marginals(marginals)),
+                np.ones(len(marginals), dtype=bool))
+
+    present = np.array([marginal is not None for marginal in marginals],
+                       dtype=bool)
+    probs = np.zeros((len(marginals), grid_world.num_hidden_states))
+    for t, marginal in enumerate(marginals):
+        if isinstance(marginal, robot.ArrayDistribution) and \
+                marginal.support is grid_world.hidden_support:
+            probs[t] = marginal.probs
+        elif marginal is not None:
+            for state, prob in marginal.items():
+                probs[t, grid_world.hidden_state_id(state)] += prob
+    return (heatmap_intensities(grid_world.position_marginals(probs)),
+            present)
+
+
+# -----------------------------------------------------------------------------
+# Rendering
+#
+
+NO_ARROW = len(robot.ACTIONS)
+
+
+def _arrow_vertices(action, cx, cy):
+    # the arrow polygon drawn over the robot by graphics.py for an action
+    if action == 'stay':
+        return [(cx - CELL_WIDTH / 5., cy - CELL_WIDTH / 5.),
+                (cx - CELL_WIDTH / 5., cy + CELL_WIDTH / 5.),
+                (cx + CELL_WIDTH / 5., cy + CELL_WIDTH / 5.),
+                (cx + CELL_WIDTH / 5., cy - CELL_WIDTH / 5.)]
+    elif action == 'left':
+        return [(cx - CELL_WIDTH / 4., cy),
+                (cx + CELL_WIDTH / 8., cy - CELL_WIDTH / 4.),
+                (cx + CELL_WIDTH / 8., cy + CELL_WIDTH / 4.)]
+    elif action == 'right':
+        return [(cx + CELL_WIDTH / 4., cy),
+                (cx - CELL_WIDTH / 8., cy - CELL_WIDTH / 4.),
+                (cx - CELL_WIDTH / 8., cy + CELL_WIDTH / 4.)]
+    elif action == 'up':
+        return [(cx, cy - CELL_HEIGHT / 4.),
+                (cx - CELL_WIDTH / 4., cy + CELL_HEIGHT / 8.),
+                (cx + CELL_WIDTH / 4., cy + CELL_HEIGHT / 8.)]
+    elif action == 'down':
+        return [(cx, cy + CELL_HEIGHT / 4.),
+                (cx - CELL_WIDTH / 4., cy - CELL_HEIGHT / 8.),
+                (cx + CELL_WIDTH / 4., cy - CELL_HEIGHT / 8.)]
+    return []
+
+
+def _inside_polygon(xs, ys, vertices):
+    # even-odd rule test of which points (xs, ys) lie inside a polygon
+    inside = np.zeros(xs.shape, dtype=bool)
+    for (x1, y1), (x2, y2) in zip(vertices, vertices[1:] + vertices[:1]):
+        crosses = (y1 > ys) != (y2 > ys)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = x1 + (ys - y1) * (x2 - x1) / (y2 - y1)
+        inside ^= crosses & (xs < x_cross)
+    return inside
+
+
+def _robot_sprites():
+    # returns (masks, colors): masks[i] says which pixels of a cell the robot
+    # covers when facing robot.ACTIONS[i] (or with no arrow for i = NO_ARROW),
+    # and colors[i] gives their colors
+    ys, xs = np.mgrid[0:CELL_HEIGHT, 0:CELL_WIDTH] + 0.5
+    cx, cy = CELL_WIDTH / 2., CELL_HEIGHT / 2.
+    oval = ((xs - cx) / (cx - 2)) ** 2 + ((ys - cy) / (cy - 2)) ** 2 <= 1
+
+    masks = np.empty((NO_ARROW + 1, CELL_HEIGHT, CELL_WIDTH), dtype=bool)
+    colors = np.empty((NO_ARROW + 1, CELL_HEIGHT, CELL_WIDTH, 3),
+                      dtype=np.uint8)
+    for i, action in enumerate(robot.ACTIONS + (None,)):
+        arrow = _inside_polygon(xs, ys, _arrow_vertices(action, cx, cy))
+        masks[i] = oval | arrow
+        colors[i] = np.where(arrow[:, :, np.newaxis], ARROW_RGB, ROBOT_RGB)
+    return masks, colors
+
+
+def _hidden_panel_states(states, grid_world):
+    # (xs, ys, sprites) for a list of hidden states or an array of hidden
+    # state ids, with xs set to -1 where there is no state
+    if isinstance(states, np.ndarray):
+        ids = states
+    else:
+        ids = np.array([-1 if state is None
+                        else grid_world.hidden_state_id(state)
+                        for state in states], dtype=np.int64)
+    valid = ids >= 0
+    return (np.where(valid, grid_world.state_xs[ids], -1),
+            np.where(valid, grid_world.state_ys[ids], -1),
+            np.where(valid, grid_world.state_actions[ids], NO_ARROW))
+
+
+def _observed_panel_states(observations, grid_world):
+    # (xs, ys, sprites) for a list of observations or an array of observed
+    # state ids, with xs set to -1 where there is no observation
+    if isinstance(observations, np.ndarray):
+        ids = observations
+    else:
+        ids = grid_world.observation_ids(observations)
+    xs, ys = np.divmod(ids, grid_world.height)
+    return (np.where(ids >= 0, xs, -1), ys,
+            np.full(len(ids), NO_ARROW))
+
+
+def render_frames(true_positions, observed_positions, estimated_positions,
+                  estimated_marginals=None, grid_world=None,
+                  chunk_size=256):
+    """
+    Renders what graphics.playback_positions shows at each time step (minus
+    the text labels) as RGB images, a chunk of time steps at a time.
+
+    Input
+    -----
+    true_positions, estimated_positions: a list of hidden states (or None)
+        per time step, or a 1D array of hidden state ids (-1 for none)
+    observed_positions: a list of observations (or None) per time step, or a
+        1D array of observed state ids (-1 for missing)
+    estimated_marginals: the marginals for the heat map (see
+        heatmap_frames()), or None for no heat map
+    grid_world: the robot.GridWorld the run comes from (defaults to
+        robot.get_compiled_model())
+    chunk_size: number of frames per chunk
+
+    Output
+    ------
+    A generator of uint8 arrays with shape (number of frames in the chunk,
+    image height, image width, 3)
+    """
+    if grid_world is None:
+        grid_world = robot.get_compiled_model()
+    num_frames = len(true_positions)
+    map_width = grid_world.width * CELL_WIDTH
+    map_height = grid_world.height * CELL_HEIGHT
+    image_height = (map_height + PADDING) * 3
+
+    if estimated_marginals is None:
+        intensities = np.zeros((num_frames, grid_world.width,
+                                grid_world.height), dtype=np.uint8)
+        present = np.zeros(num_frames, dtype=bool)
+    else:
+        intensities, present = heatmap_frames(estimated_marginals,
+                                              grid_world)
+    panels = [_hidden_panel_states(true_positions, grid_world),
+              _observed_panel_states(observed_positions, grid_world),
+              _hidden_panel_states(estimated_positions, grid_world)]
+    sprite_masks, sprite_colors = _robot_sprites()
+
+    sprite_rows = np.arange(CELL_HEIGHT)
+    sprite_columns = np.arange(CELL_WIDTH)
+
+    for start in range(0, num_frames, chunk_size):
+        frames = np.arange(start, min(start + chunk_size, num_frames))
+        images = np.empty((len(frames), image_height, map_width, 3),
+                          dtype=np.uint8)
+
+        for panel, (xs, ys, sprites) in enumerate(panels):
+            xs, ys, sprites = xs[frames], ys[frames], sprites[frames]
+            offset = panel * (map_height + PADDING)
+
+            # cell colors, indexed by (frame, y, x): black, or red when the
+            # panel has no state, with the heat map on the bottom map
+            cell_colors = np.empty((len(frames), grid_world.height,
+                                    grid_world.width, 3), dtype=np.uint8)
+            cell_colors[:] = np.where((xs < 0)[:, np.newaxis, np.newaxis,
+                                               np.newaxis],
+                                      MISSING_CELL_RGB, CELL_RGB)
+            if panel == 2:
+                heated = np.flatnonzero(present[frames])
+                cell_colors[heated] = 0
+                cell_colors[heated, :, :, 0] = \
+                    intensities[frames[heated]].transpose(0, 2, 1)
+
+            # widen the cells into rows of pixels, with the outlines along
+            # the left edges of the cells, and copy those rows down each cell
+            # but its top edge, which is outline too
+            pixel_rows = np.repeat(cell_colors, CELL_WIDTH, axis=2)
+            pixel_rows[:, :, ::CELL_WIDTH] = OUTLINE_RGB
+            cells = images[:, offset:offset + map_height].reshape(
+                len(frames), grid_world.height, CELL_HEIGHT, map_width, 3)
+            cells[...] = pixel_rows[:, :, np.newaxis]
+            cells[:, :, 0] = OUTLINE_RGB
+            images[:, offset + map_height:offset + map_height + PADDING] = \
+                BACKGROUND_RGB
+
+            # paste the robot into the frames that have a state
+            shown = np.flatnonzero(xs >= 0)
+            rows = offset + ys[shown, np.newaxis] * CELL_HEIGHT + sprite_rows
+            columns = xs[shown, np.newaxis] * CELL_WIDTH + sprite_columns
+            index = (shown[:, np.newaxis, np.newaxis],
+                     rows[:, :, np.newaxis], columns[:, np.newaxis, :])
+            images[index] = np.where(
+                sprite_masks[sprites[shown]][..., np.newaxis],
+                sprite_colors[sprites[shown]], images[index])
+
+        yield images
+
+
+# -----------------------------------------------------------------------------
+# Writing frames
+#
+
+def encode_png(image, compression_level=6):
+    """
+    Encodes a height x width x 3 uint8 RGB image as PNG file contents.
+    """
+    height, width, _ = image.shape
+    # every scanline starts with filter type 0 (none)
+    scanlines = np.zeros((height, width * 3 + 1), dtype=np.uint8)
+    scanlines[:, 1:] = image.reshape(height, width * 3)
+
+    def chunk(chunk_type, data):
+        return struct.pack('>I', len(data)) + chunk_type + data + \
+            struct.pack('>I', zlib.crc32(chunk_type + data))
+
+    return b'\x89PNG\r\n\x1a\n' + \
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0,
+                                   0)) + \
+        chunk(b'IDAT', zlib.compress(scanlines.tobytes(),
+                                     compression_level)) + \
+        chunk(b'IEND', b'')
+
+
+def save_npy(filename, true_positions, observed_positions,
+             estimated_positions, estimated_marginals=None, grid_world=None,
+             chunk_size=256):
+    """
+    Renders a run (see render_frames()) into a single .npy file holding a
+    (number of frames) x height x width x 3 uint8 array, without keeping more
+    than one chunk of frames in memory.
+    """
+    frames = None
+    start = 0
+    for images in render_frames(true_positions, observed_positions,
+                                estimated_positions, estimated_marginals,
+                                grid_world, chunk_size):
+        if frames is None:
+            frames = np.lib.format.open_memmap(
+                filename, mode='w+', dtype=np.uint8,
+                shape=(len(true_positions),) + images.shape[1:])
+        frames[start:start + len(images)] = images
+        start += len(images)
+    if frames is not None:
+        frames.flush()
+
+
+def save_png_sequence(filename_pattern, true_positions, observed_positions,
+                      estimated_positions, estimated_marginals=None,
+                      grid_world=None, chunk_size=256, compression_level=6):
+    """
+    Renders a run (see render_frames()) into one PNG file per frame, named by
+    filename_pattern % frame (e.g., 'frames/frame%05d.png').
+
+    Output
+    ------
+    The list of filenames written
+    """
+    filenames = []
+    for images in render_frames(true_positions, observed_positions,
+                                estimated_positions, estimated_marginals,
+                                grid_world, chunk_size):
+        for image in images:
+            filename = filename_pattern % len(filenames)
+            with open(filename, 'wb') as f:
+                f.write(encode_png(image, compression_level))
+            filenames.append(filename)
+    return filenames
+
+
+def save_animation(filename, true_positions, observed_positions,
+                   estimated_positions, estimated_marginals=None,
+                   grid_world=None, chunk_size=256,
+                   frames_per_second=FRAMES_PER_SECOND):
+    """
+    Renders a run (see render_frames()) into an animated file (e.g., a .gif,
+    or a .mp4 with imageio's ffmpeg plugin), which needs imageio installed.
+    """
+    if imageio is None:
+        raise ImportError('save_animation() needs imageio installed')
+    with imageio.get_writer(filename, fps=frames_per_second) as writer:
+        for images in render_frames(true_positions, observed_positions,
+                                    estimated_positions, estimated_marginals,
+                                    grid_world, chunk_size):
+            for image in images:
+                writer.append_data(image)
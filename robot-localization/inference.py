@@ -2,6 +2,7 @@
 # inference.py
 # Base code by George H. Chen (georgehc@mit.edu) -- updated 10/18/2016
 import collections
+import concurrent.futures
 import sys
 
 import graphics
@@ -39,12 +40,14 @@ def careful_log(x):
 # Functions for you to implement
 #
 
-def forward_backward(observations):
+def forward_backward(observations, model=None):
     """
     Input
     -----
     observations: a list of observations, one per hidden state
         (a missing observation is encoded as None)
+    model: the robot.CompiledModel to use, e.g., a robot.GridWorld (defaults
+        to robot.get_compiled_model())
 
     Output
     ------
@@ -59,19 +62,21 @@ def forward_backward(observations):
     # YOUR CODE GOES HERE
     #
 
+    if model is None:
+        model = robot.get_compiled_model()
     num_time_steps = len(observations)
     forward_messages = [None] * num_time_steps
-    forward_messages[0] = prior_distribution
+    forward_messages[0] = model.initial_distribution()
     # TODO: Compute the forward messages
     for t in range(1, num_time_steps):
         forward_messages[t] = robot.Distribution()
         for state, p in forward_messages[t-1].items():
             observation = observations[t-1]
             if observation is not None:
-                p_observation = observation_model(state)[observation]
+                p_observation = model.observation_model(state)[observation]
             else:
                 p_observation = 1.0    # This means do not include observation
-            for next_state, p_next_state in transition_model(state).items():
+            for next_state, p_next_state in model.transition_model(state).items():
                 forward_messages[t][next_state] += p * p_observation * p_next_state
         forward_messages[t].renormalize()
     
@@ -79,13 +84,14 @@ def forward_backward(observations):
     # TODO: Compute the backward messages
     
     # Compute backward transition model
+    hidden_states = model.hidden_states
     backward_transition_model = collections.defaultdict(robot.Distribution)
-    for state in all_possible_hidden_states:
-        for next_state, p in transition_model(state).items():
+    for state in hidden_states:
+        for next_state, p in model.transition_model(state).items():
             backward_transition_model[next_state][state] += p
     
     backward_messages[-1] = robot.Distribution()
-    for state in all_possible_hidden_states:
+    for state in hidden_states:
         backward_messages[-1][state] = 1;
         
     for t in reversed(range(num_time_steps-1)):
@@ -94,7 +100,7 @@ def forward_backward(observations):
             possible_previous_states = backward_transition_model[state]
             observation = observations[t+1]
             if observation is not None:
-                p_observation = observation_model(state)[observation]
+                p_observation = model.observation_model(state)[observation]
             else:
                 p_observation = 1.0  # This means do not include observation
             for previous_state, p_previous_state in possible_previous_states.items():
@@ -106,9 +112,9 @@ def forward_backward(observations):
     for t in range(num_time_steps):
         marginals[t] = robot.Distribution()
         observation = observations[t]
-        for state in all_possible_hidden_states:
+        for state in hidden_states:
             if observation is not None:
-                p_observation = observation_model(state)[observation]
+                p_observation = model.observation_model(state)[observation]
             else:
                 p_observation = 1.0
             marginals[t][state] = forward_messages[t][state] * backward_messages[t][state] * p_observation
@@ -117,12 +123,14 @@ def forward_backward(observations):
     return marginals
 
 
-def Viterbi(observations):
+def Viterbi(observations, model=None):
     """
     Input
     -----
     observations: a list of observations, one per hidden state
         (a missing observation is encoded as None)
+    model: the robot.CompiledModel to use, e.g., a robot.GridWorld (defaults
+        to robot.get_compiled_model())
 
     Output
     ------
@@ -135,11 +143,13 @@ def Viterbi(observations):
     #
     
 
+    if model is None:
+        model = robot.get_compiled_model()
     num_time_steps = len(observations)
     estimated_hidden_states = [None] * num_time_steps # remove this
     
-    min_sum_messages = [prior_distribution]
-    for state, p in prior_distribution.items():
+    min_sum_messages = [{}]
+    for state, p in model.initial_distribution().items():
         min_sum_messages[0][state] = (-careful_log(p), None)
     
     x_end = {}
@@ -148,11 +158,11 @@ def Viterbi(observations):
         for state, (p, _) in min_sum_messages[t].items():
             observation = observations[t]
             if observation is not None:
-                p_observation = observation_model(state)[observation]
+                p_observation = model.observation_model(state)[observation]
             else:
                 p_observation = 1
             if t != num_time_steps-1:
-                for next_state, p_next_state in transition_model(state).items():
+                for next_state, p_next_state in model.transition_model(state).items():
                     m = - careful_log(p_next_state) - careful_log(p_observation) + p
                     if m < next_min_sum_message.setdefault(next_state, (np.inf, None))[0]:
                         next_min_sum_message[next_state] = (m, state)
@@ -172,37 +182,934 @@ def Viterbi(observations):
     return estimated_hidden_states
 
 
-def second_best(observations):
+# -----------------------------------------------------------------------------
+# Vectorized Viterbi
+#
+# Hidden states and observed states are referred to by their ids in the
+# compiled model (see robot.CompiledModel). Since every hidden state has only a
+# handful of possible previous states, the transition model is used in the form
+# of the model's padded predecessor table, so one max-plus step costs
+# O(number of states).
+#
+
+def _log(x):
+    # elementwise version of careful_log()
+    with np.errstate(divide='ignore'):
+        return np.log(x)
+
+
+def Viterbi_vectorized(observations, model=None):
     """
+    Same as Viterbi() but with the model precompiled into log-probability
+    arrays and the max-plus recursion run over state indexes with NumPy.
+    Backpointers are stored as a (number of time steps) x (number of hidden
+    states) int16 array of predecessor table columns, so both time and memory
+    grow linearly with the number of time steps.
+
     Input
     -----
     observations: a list of observations, one per hidden state
         (a missing observation is encoded as None)
+    model: the robot.CompiledModel to use, e.g., a robot.GridWorld (defaults
+        to robot.get_compiled_model())
 
     Output
     ------
     A list of esimated hidden states, each encoded as a tuple
     (<x>, <y>, <action>)
     """
+    num_time_steps = len(observations)
+    if num_time_steps == 0:
+        return []
 
-    # -------------------------------------------------------------------------
-    # YOUR CODE GOES HERE
-    #
+    if model is None:
+        model = robot.get_compiled_model()
+    predecessors, transition_probs = model.predecessor_table()
+    log_transitions = _log(transition_probs)
+    observation_ids = model.observation_ids(observations)
+    num_hidden_states = model.num_hidden_states
+    rows = np.arange(num_hidden_states)
 
+    backpointers = np.zeros((num_time_steps, num_hidden_states),
+                            dtype=np.int16)
+    log_probs = _log(model.prior)
+    for t in range(num_time_steps):
+        if t > 0:
+            candidates = log_probs[predecessors] + log_transitions
+            best = np.argmax(candidates, axis=1)
+            backpointers[t] = best
+            log_probs = candidates[rows, best]
+        if observation_ids[t] >= 0:
+            log_probs += _log(
+                model.observation_likelihoods(observation_ids[t]))
 
-    num_time_steps = len(observations)
-    estimated_hidden_states = [None] * num_time_steps # remove this
+    # Backtrace to decide all hidden states
+    estimated_hidden_states = [None] * num_time_steps
+    state = int(np.argmax(log_probs))
+    for t in reversed(range(num_time_steps)):
+        estimated_hidden_states[t] = model.hidden_state(state)
+        state = predecessors[state, backpointers[t, state]]
 
     return estimated_hidden_states
 
 
+def _top_k(values, k):
+    # returns a 2D array with the column indexes of the k largest entries of
+    # each row of `values`, from largest to smallest, with ties going to the
+    # lower column index (the same as the first k columns of a stable argsort
+    # of -values), in O(number of columns + k log k) time per row; ties at
+    # -inf may be broken either way, since such entries are never backtraced
+    top = np.argpartition(-values, k - 1, axis=1)[:, :k]
+    top_values = np.take_along_axis(values, top, axis=1)
+    # argpartition may split a tie at the k-th largest value arbitrarily, so
+    # rows where it left some of the tied entries out are redone in full
+    threshold = top_values.min(axis=1, keepdims=True)
+    split = np.flatnonzero(
+        np.isfinite(threshold[:, 0]) &
+        ((values == threshold).sum(axis=1) >
+         (top_values == threshold).sum(axis=1)))
+    if len(split) > 0:
+        top[split] = np.argsort(-values[split], axis=1,
+                                kind='stable')[:, :k]
+        top_values[split] = np.take_along_axis(values[split], top[split],
+                                               axis=1)
+    order = np.lexsort((top, -top_values), axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+
+def k_best_paths(observations, k, model=None):
+    """
+    List Viterbi: finds the k most likely sequences of hidden states.
+
+    For every hidden state, the log probabilities of the k best partial paths
+    ending there are kept in a (number of hidden states) x k array. Each time
+    step selects them from the (predecessor table width) * k candidates of
+    every hidden state that has a partial path of nonzero probability into
+    it, in linear time, and sorts only the k selected ones, so this takes
+    O(number of time steps * number of nonzero transition probabilities * k
+    + number of time steps * number of hidden states * k log k) time.
+    Backpointers take one int16 (for k up to several thousand) per time step,
+    hidden state and rank. Ties are broken
+    deterministically, in favor of the earlier predecessor table column and
+    then the better-ranked partial path (at the last time step, in favor of
+    the lower hidden state id).
+
+    Input
+    -----
+    observations: a list of observations, one per hidden state
+        (a missing observation is encoded as None)
+    k: how many paths to find
+    model: the robot.CompiledModel to use (defaults to
+        robot.get_compiled_model())
+
+    Output
+    ------
+    (paths, log_probabilities), where paths is a list of the (up to) k most
+    likely lists of hidden states, from most to least likely, and
+    log_probabilities is a 1D array of their joint log probabilities with the
+    observations (fewer than k paths are returned if fewer than k paths have
+    nonzero probability)
+    """
+    num_time_steps = len(observations)
+    if num_time_steps == 0:
+        return [], np.zeros(0)
+
+    if model is None:
+        model = robot.get_compiled_model()
+    predecessors, transition_probs = model.predecessor_table()
+    log_transitions = _log(transition_probs)
+    observation_ids = model.observation_ids(observations)
+    num_hidden_states, max_in_degree = predecessors.shape
+
+    # backpointers[t, j, r] = (predecessor table column) * k + (rank of the
+    # partial path at that predecessor) for the r-th best path ending at j
+    backpointers = np.zeros((num_time_steps, num_hidden_states, k),
+                            dtype=np.int16 if max_in_degree * k <= 2**15
+                            else np.int32)
+    log_probs = np.full((num_hidden_states, k), -np.inf)
+    log_probs[:, 0] = _log(model.prior)
+    for t in range(num_time_steps):
+        if t > 0:
+            # only hidden states with a partial path of nonzero probability
+            # into them need their candidates ranked; the rest stay at -inf
+            reached = np.flatnonzero(
+                (np.isfinite(log_probs[predecessors, 0]) &
+                 np.isfinite(log_transitions)).any(axis=1))
+            candidates = (log_probs[predecessors[reached]] +
+                          log_transitions[reached, :, np.newaxis]).reshape(
+                              len(reached), max_in_degree * k)
+            best = _top_k(candidates, k)
+            backpointers[t, reached] = best
+            log_probs = np.full((num_hidden_states, k), -np.inf)
+            log_probs[reached] = np.take_along_axis(candidates, best, axis=1)
+        if observation_ids[t] >= 0:
+            log_probs += _log(model.observation_likelihoods(
+                observation_ids[t]))[:, np.newaxis]
+
+    # Backtrace each of the k best (hidden state, rank) pairs at the end
+    final = _top_k(log_probs.reshape(1, -1), min(k, log_probs.size))[0]
+    final = final[np.isfinite(log_probs.ravel()[final])]
+    paths = []
+    for state, rank in zip(*np.divmod(final, k)):
+        path = [None] * num_time_steps
+        for t in reversed(range(num_time_steps)):
+            path[t] = model.hidden_state(state)
+            column, rank = divmod(int(backpointers[t, state, rank]), k)
+            state = predecessors[state, column]
+        paths.append(path)
+
+    return paths, log_probs.ravel()[final]
+
+
+def second_best(observations, model=None):
+    """
+    Input
+    -----
+    observations: a list of observations, one per hidden state
+        (a missing observation is encoded as None)
+    model: the robot.CompiledModel to use, e.g., a robot.GridWorld (defaults
+        to robot.get_compiled_model())
+
+    Output
+    ------
+    A list of esimated hidden states, each encoded as a tuple
+    (<x>, <y>, <action>)
+    """
+    paths, _ = k_best_paths(observations, 2, model)
+    if len(paths) < 2:
+        return [None] * len(observations)
+    return paths[1]
+
+
+# -----------------------------------------------------------------------------
+# Batched inference over many observation sequences
+#
+# All sequences share one model, so each forward-backward time step is a single
+# sparse matrix product with a (number of hidden states) x B block of beliefs,
+# and each Viterbi time step is a single max-plus step over a
+# (number of hidden states) x B block of log probabilities.
+#
+
+def _observation_id_batch(observation_sequences, model, lengths=None):
+    """
+    Input
+    -----
+    observation_sequences: either a list of B lists of observations (of any
+        lengths, with a missing observation encoded as None), or a padded 2D
+        array of observed state ids with B rows (with -1 for a missing
+        observation)
+    model: the robot.CompiledModel the observations come from
+    lengths: for a padded 2D array, the number of time steps in each row
+        (defaults to all of them)
+
+    Output
+    ------
+    (observation_ids, lengths), where observation_ids is a B x (maximum
+    length) array of observed state ids padded with -1 (missing)
+    """
+    if isinstance(observation_sequences, np.ndarray):
+        observation_ids = observation_sequences.astype(np.int64, copy=False)
+        if lengths is None:
+            lengths = [observation_ids.shape[1]] * len(observation_ids)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        padding = np.arange(observation_ids.shape[1]) >= lengths[:, None]
+        if padding.any():
+            observation_ids = np.where(padding, -1, observation_ids)
+        return observation_ids, lengths
+
+    lengths = np.array([len(observations)
+                        for observations in observation_sequences],
+                       dtype=np.int64)
+    observation_ids = np.full((len(lengths), lengths.max(initial=0)), -1,
+                              dtype=np.int64)
+    for b, observations in enumerate(observation_sequences):
+        observation_ids[b, :lengths[b]] = model.observation_ids(observations)
+    return observation_ids, lengths
+
+
+def _forward_block(model, observation_ids, keep_beliefs=True):
+    # filtering for a block of padded observation id sequences, with the
+    # beliefs scaled to sum to 1 at every time step; returns (forward,
+    # log_likelihoods) where forward[t] holds the filtered beliefs (one column
+    # per sequence, or None if keep_beliefs is False) and log_likelihoods
+    # holds the sums of the logs of the scaling factors, i.e., the log
+    # probabilities of the observation sequences; padding is treated as
+    # missing observations, whose scaling factors are 1
+    num_sequences, num_time_steps = observation_ids.shape
+    transposed_transitions = model.transition_matrix.T.tocsr()
+
+    forward = None
+    if keep_beliefs:
+        forward = np.empty((num_time_steps, model.num_hidden_states,
+                            num_sequences))
+    log_likelihoods = np.zeros(num_sequences)
+    belief = np.repeat(model.prior[:, np.newaxis], num_sequences, axis=1)
+    for t in range(num_time_steps):
+        if t > 0:
+            belief = transposed_transitions.dot(belief)
+        belief *= model.observation_likelihood_columns(observation_ids[:, t])
+        scaling_factors = belief.sum(axis=0)
+        log_likelihoods += _log(scaling_factors)
+        belief /= scaling_factors
+        if keep_beliefs:
+            forward[t] = belief
+    return forward, log_likelihoods
+
+
+def _forward_backward_block(model, observation_ids, lengths):
+    # forward-backward for a block of padded observation id sequences,
+    # returning a list of (marginals, log likelihood) pairs; padding is
+    # treated as missing observations, which leaves the marginals within each
+    # sequence unchanged
+    num_sequences, num_time_steps = observation_ids.shape
+    forward, log_likelihoods = _forward_block(model, observation_ids)
+
+    # turn forward[t] into the marginals in place
+    backward = np.ones((model.num_hidden_states, num_sequences))
+    for t in reversed(range(num_time_steps)):
+        forward[t] *= backward
+        forward[t] /= forward[t].sum(axis=0)
+        backward *= model.observation_likelihood_columns(observation_ids[:, t])
+        backward = model.transition_matrix.dot(backward)
+        backward /= backward.sum(axis=0)
+
+    return [(np.ascontiguousarray(forward[:lengths[b], :, b]),
+             log_likelihoods[b])
+            for b in range(num_sequences)]
+
+
+def _log_likelihood_block(model, observation_ids, lengths):
+    # log probabilities of a block of padded observation id sequences
+    _, log_likelihoods = _forward_block(model, observation_ids,
+                                        keep_beliefs=False)
+    return list(log_likelihoods)
+
+
+def _Viterbi_block(model, observation_ids, lengths):
+    # Viterbi for a block of padded observation id sequences, returning a list
+    # of hidden state id arrays; each sequence is backtraced from its own last
+    # time step, so padding does not affect it
+    #
+    # Messages are (number of hidden states) x B, so gathering the messages
+    # of each predecessor column copies whole rows, and the max over the few
+    # predecessor columns is kept as a running max instead of materializing
+    # all of them. On a 20 x 20 grid with B = 128 sequences of 100 time steps
+    # this takes about 0.75 s, against about 1.2 s for calling
+    # Viterbi_vectorized() on each sequence (and 3.4 s for materializing a
+    # B x (number of hidden states) x (number of predecessor columns) array
+    # of candidates at each time step).
+    num_sequences, num_time_steps = observation_ids.shape
+    predecessors, transition_probs = model.predecessor_table()
+    log_transitions = _log(transition_probs)
+    num_hidden_states, num_columns = predecessors.shape
+    sequences = np.arange(num_sequences)
+
+    backpointers = np.zeros((num_time_steps, num_hidden_states,
+                             num_sequences), dtype=np.int16)
+    final_states = np.zeros(num_sequences, dtype=np.int64)
+    log_probs = np.repeat(_log(model.prior)[:, np.newaxis], num_sequences,
+                          axis=1)
+    candidates = np.empty_like(log_probs)
+    better = np.empty(log_probs.shape, dtype=bool)
+    for t in range(num_time_steps):
+        if t > 0:
+            best = backpointers[t]
+            best_log_probs = log_probs[predecessors[:, 0]]
+            best_log_probs += log_transitions[:, 0:1]
+            for column in range(1, num_columns):
+                np.take(log_probs, predecessors[:, column], axis=0,
+                        out=candidates)
+                candidates += log_transitions[:, column:column + 1]
+                np.greater(candidates, best_log_probs, out=better)
+                np.copyto(best_log_probs, candidates, where=better)
+                np.copyto(best, column, where=better)
+            log_probs = best_log_probs
+        log_probs += model.log_observation_likelihood_columns(
+            observation_ids[:, t])
+        ending = lengths == t + 1
+        final_states[ending] = np.argmax(log_probs[:, ending], axis=0)
+
+    # Backtrace all sequences at once
+    paths = np.zeros((num_sequences, num_time_steps), dtype=np.int64)
+    states = final_states
+    for t in reversed(range(num_time_steps)):
+        active = t < lengths
+        paths[active, t] = states[active]
+        previous_states = predecessors[
+            states, backpointers[t, states, sequences]]
+        states = np.where(active, previous_states, states)
+
+    return [paths[b, :lengths[b]] for b in range(num_sequences)]
+
+
+def _run_batch(block_function, model, observation_ids, lengths,
+               num_workers):
+    # runs block_function over the whole batch, or over num_workers shards of
+    # it in a process pool
+    if num_workers is None or num_workers <= 1 or len(lengths) <= 1:
+        return block_function(model, observation_ids, lengths)
+
+    shards = [shard for shard in np.array_split(np.arange(len(lengths)),
+                                                num_workers)
+              if len(shard) > 0]
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(len(shards)) as executor:
+        futures = [executor.submit(block_function, model,
+                                   observation_ids[shard], lengths[shard])
+                   for shard in shards]
+        for future in futures:
+            results.extend(future.result())
+    return results
+
+
+def forward_backward_batch(observation_sequences, model=None, lengths=None,
+                           num_workers=None, return_log_likelihoods=False):
+    """
+    Runs forward-backward on many observation sequences together.
+
+    Input
+    -----
+    observation_sequences: either a list of B lists of observations (of any
+        lengths, with a missing observation encoded as None), or a padded 2D
+        array of observed state ids with B rows (with -1 for a missing
+        observation)
+    model: the robot.CompiledModel to use (defaults to
+        robot.get_compiled_model())
+    lengths: for a padded 2D array, the number of time steps in each row
+        (defaults to all of them)
+    num_workers: if more than 1, the sequences are split into this many
+        shards that are processed in a process pool
+    return_log_likelihoods: whether to also return the log probability of
+        each observation sequence
+
+    Output
+    ------
+    A list of B 2D arrays, where the b-th array has one row per time step of
+    the b-th sequence, and row t holds the marginal distribution at time step
+    t indexed by hidden state id; if return_log_likelihoods is True, a 1D
+    array of the B log likelihoods is returned as well
+    """
+    if model is None:
+        model = robot.get_compiled_model()
+    observation_ids, lengths = \
+        _observation_id_batch(observation_sequences, model, lengths)
+    results = _run_batch(_forward_backward_block, model, observation_ids,
+                         lengths, num_workers)
+    marginals = [marginal for marginal, _ in results]
+    if return_log_likelihoods:
+        return marginals, np.array([log_likelihood
+                                    for _, log_likelihood in results])
+    return marginals
+
+
+def forward_backward_scaled(observations, model=None):
+    """
+    Forward-backward with every forward and backward message scaled to sum to
+    1, so nothing underflows however long the sequence is, and with the log
+    probability of the whole observation sequence (the sum of the logs of the
+    forward scaling factors) as a by-product.
+
+    Input
+    -----
+    observations: a list of observations, one per hidden state
+        (a missing observation is encoded as None)
+    model: the robot.CompiledModel to use (defaults to
+        robot.get_compiled_model())
+
+    Output
+    ------
+    (marginals, log_likelihood), where marginals is a 2D array with one row
+    per time step holding the marginal distribution indexed by hidden state
+    id, and log_likelihood is the log probability of the observations
+    """
+    if model is None:
+        model = robot.get_compiled_model()
+    observation_ids = model.observation_ids(observations)
+    return _forward_backward_block(model, observation_ids[np.newaxis],
+                                   [len(observation_ids)])[0]
+
+
+def log_likelihood_batch(observation_sequences, model=None, lengths=None,
+                         num_workers=None):
+    """
+    Computes the log probability of each of many observation sequences with a
+    single scaled forward pass (no backward pass, and no messages kept), e.g.,
+    for comparing models.
+
+    Input
+    -----
+    observation_sequences, model, lengths, num_workers: see
+        forward_backward_batch()
+
+    Output
+    ------
+    A 1D array of the B log likelihoods
+    """
+    if model is None:
+        model = robot.get_compiled_model()
+    observation_ids, lengths = \
+        _observation_id_batch(observation_sequences, model, lengths)
+    return np.array(_run_batch(_log_likelihood_block, model, observation_ids,
+                               lengths, num_workers))
+
+
+def Viterbi_batch(observation_sequences, model=None, lengths=None,
+                  num_workers=None):
+    """
+    Runs Viterbi on many observation sequences together.
+
+    Input
+    -----
+    observation_sequences, model, lengths, num_workers: see
+        forward_backward_batch()
+
+    Output
+    ------
+    A list of B lists of estimated hidden states, each encoded as a tuple
+    (<x>, <y>, <action>)
+    """
+    if model is None:
+        model = robot.get_compiled_model()
+    observation_ids, lengths = \
+        _observation_id_batch(observation_sequences, model, lengths)
+    paths = _run_batch(_Viterbi_block, model, observation_ids, lengths,
+                       num_workers)
+    return [[model.hidden_state(i) for i in path.tolist()] for path in paths]
+
+
+def array_distributions(marginals, model=None):
+    """
+    Wraps marginals computed as arrays (e.g., by forward_backward_batch()) as
+    robot.ArrayDistributions sharing the model's hidden state support, without
+    copying them.
+
+    Input
+    -----
+    marginals: a 2D array with one row per time step, indexed by hidden state
+        id (or any iterable of such rows)
+    model: the robot.CompiledModel the marginals come from (defaults to
+        robot.get_compiled_model())
+
+    Output
+    ------
+    A list of robot.ArrayDistributions, one per time step
+    """
+    if model is None:
+        model = robot.get_compiled_model()
+    return [robot.ArrayDistribution(model.hidden_support, marginal)
+            for marginal in marginals]
+
+
+# -----------------------------------------------------------------------------
+# Online filtering and fixed-lag smoothing
+#
+
+class OnlineFilter(object):
+    """
+    Forward filtering for observations that arrive one time step at a time,
+    with an optional fixed-lag smoother.
+
+    Beliefs and marginals are 1D arrays indexed by hidden state id (see
+    robot.CompiledModel). Each update() costs O(number of nonzero transition
+    probabilities). With lag L > 0, only the last L + 1 filtered beliefs are
+    kept, and each update() additionally runs an L-step backward pass over
+    them, so memory stays O(L * number of hidden states) however long the
+    stream is.
+
+    Inputs
+    ------
+    - model: the robot.CompiledModel to use (defaults to
+        robot.get_compiled_model())
+    - lag: how many time steps the smoothed marginals trail behind the most
+        recent observation
+
+    Methods
+    -------
+    update(observation):
+      takes the next observation (None if missing) and returns the filtered
+      belief for that time step, i.e., conditioned on all observations so far
+    smoothed_marginal():
+      returns (time step, marginal) for the time step `lag` behind the most
+      recent one, conditioned on all observations so far, or None if fewer
+      than lag + 1 observations have been seen
+    flush():
+      at the end of the stream, yields (time step, marginal) for the time
+      steps that smoothed_marginal() has not reached yet
+    """
+
+    def __init__(self, model=None, lag=0):
+        if model is None:
+            model = robot.get_compiled_model()
+        self.model = model
+        self.lag = lag
+        self.time_step = -1
+        self._transposed_transitions = model.transition_matrix.T.tocsr()
+        self._belief = None
+        # (time step, filtered belief, observation likelihoods or None)
+        self._window = collections.deque()
+        self._smoothed = None
+
+    def update(self, observation):
+        if observation is None:
+            likelihoods = None
+        else:
+            likelihoods = self.model.observation_likelihoods(
+                self.model.observed_state_id(observation))
+
+        if self._belief is None:
+            belief = self.model.prior.copy()
+        else:
+            belief = self._transposed_transitions.dot(self._belief)
+        if likelihoods is not None:
+            belief *= likelihoods
+        belief /= belief.sum()
+
+        self.time_step += 1
+        self._belief = belief
+        self._window.append((self.time_step, belief, likelihoods))
+        if len(self._window) > self.lag:
+            self._smoothed = self._smooth_oldest()
+            self._window.popleft()
+        return belief
+
+    def smoothed_marginal(self):
+        return self._smoothed
+
+    def flush(self):
+        for smoothed in self._smooth_window():
+            yield smoothed
+        self._window.clear()
+
+    def _smooth_oldest(self):
+        # returns (time step, marginal) for the oldest time step in the
+        # window, conditioned on all observations so far, keeping only the
+        # backward message instead of every marginal in the window
+        backward_message = np.ones(self.model.num_hidden_states)
+        for index in range(len(self._window) - 1, 0, -1):
+            likelihoods = self._window[index][2]
+            if likelihoods is not None:
+                backward_message *= likelihoods
+            backward_message = self.model.transition_matrix.dot(
+                backward_message)
+            backward_message /= backward_message.sum()
+        time_step, belief, _ = self._window[0]
+        marginal = belief * backward_message
+        return time_step, marginal / marginal.sum()
+
+    def _smooth_window(self):
+        # returns a list of (time step, marginal) for every time step in the
+        # window, conditioned on all observations so far
+        smoothed = []
+        backward_message = np.ones(self.model.num_hidden_states)
+        for time_step, belief, likelihoods in reversed(self._window):
+            marginal = belief * backward_message
+            smoothed.append((time_step, marginal / marginal.sum()))
+            if likelihoods is not None:
+                backward_message = backward_message * likelihoods
+            backward_message = self.model.transition_matrix.dot(
+                backward_message)
+            backward_message /= backward_message.sum()
+        smoothed.reverse()
+        return smoothed
+
+
+def fixed_lag_smoothing(observations, lag, model=None):
+    """
+    Runs an OnlineFilter with the given lag over a sequence of observations.
+
+    Input
+    -----
+    observations: an iterable of observations, one per hidden state
+        (a missing observation is encoded as None)
+    lag: see OnlineFilter
+    model: the robot.CompiledModel to use (defaults to
+        robot.get_compiled_model())
+
+    Output
+    ------
+    A generator of smoothed marginals, one per time step and in order, each a
+    1D array indexed by hidden state id; with lag >= len(observations) - 1,
+    these are the same marginals that forward_backward() computes
+    """
+    online_filter = OnlineFilter(model, lag)
+    for observation in observations:
+        online_filter.update(observation)
+        smoothed = online_filter.smoothed_marginal()
+        if smoothed is not None:
+            yield smoothed[1]
+    for _, marginal in online_filter.flush():
+        yield marginal
+
+
+# -----------------------------------------------------------------------------
+# Checkpointed forward-backward for very long observation sequences
+#
+
+def _forward_step(model, transposed_transitions, belief, observation_id):
+    # returns the filtered belief at the next time step given the one at the
+    # current time step (or the prior if belief is None)
+    if belief is None:
+        belief = model.prior.copy()
+    else:
+        belief = transposed_transitions.dot(belief)
+    if observation_id >= 0:
+        belief *= model.observation_likelihoods(observation_id)
+    return belief / belief.sum()
+
+
+def _backward_step(model, backward_message, observation_id):
+    # returns the backward message at the previous time step given the one at
+    # the current time step and the current time step's observed state id
+    if observation_id >= 0:
+        backward_message = \
+            backward_message * model.observation_likelihoods(observation_id)
+    backward_message = model.transition_matrix.dot(backward_message)
+    return backward_message / backward_message.sum()
+
+
+def forward_backward_checkpointed(observations, model=None,
+                                  checkpoint_interval=None):
+    """
+    Same marginals as forward_backward(), but using memory that grows with
+    the square root of the number of time steps T rather than with T.
+
+    A first backward pass keeps only the backward messages at the end of every
+    segment of `checkpoint_interval` time steps (default: about sqrt(T)). The
+    forward pass then recomputes each segment's backward messages from its
+    checkpoint right before yielding that segment's marginals, so at most
+    T / checkpoint_interval + checkpoint_interval messages are ever held, at
+    the cost of computing the backward messages twice. (This is the usual
+    checkpointing scheme run in the other direction: checkpointing forward
+    messages and recomputing them during the backward pass would yield the
+    marginals from the last time step to the first, whereas checkpointing
+    backward messages lets them be yielded in time order.)
+
+    Input
+    -----
+    observations: a list of observations, one per hidden state (a missing
+        observation is encoded as None), or a 1D array of observed state ids
+        (with -1 for a missing observation)
+    model: the robot.CompiledModel to use (defaults to
+        robot.get_compiled_model())
+    checkpoint_interval: number of time steps per segment
+
+    Output
+    ------
+    A generator of marginal distributions, one per time step and in order,
+    each a 1D array indexed by hidden state id
+    """
+    if model is None:
+        model = robot.get_compiled_model()
+    if isinstance(observations, np.ndarray):
+        observation_ids = observations
+    else:
+        observation_ids = model.observation_ids(observations)
+    num_time_steps = len(observation_ids)
+    if checkpoint_interval is None:
+        checkpoint_interval = max(int(np.ceil(np.sqrt(num_time_steps))), 1)
+    transposed_transitions = model.transition_matrix.T.tocsr()
+
+    # Backward pass, keeping the backward message at each segment's end
+    checkpoints = {}
+    backward_message = np.ones(model.num_hidden_states)
+    for t in reversed(range(num_time_steps)):
+        if (t + 1) % checkpoint_interval == 0 or t == num_time_steps - 1:
+            checkpoints[t] = backward_message
+        if t > 0:
+            backward_message = _backward_step(model, backward_message,
+                                              observation_ids[t])
+
+    # Forward pass, one segment at a time
+    belief = None
+    for start in range(0, num_time_steps, checkpoint_interval):
+        end = min(start + checkpoint_interval, num_time_steps)
+        segment_backward_messages = [None] * (end - start)
+        backward_message = checkpoints.pop(end - 1)
+        for t in reversed(range(start, end)):
+            segment_backward_messages[t - start] = backward_message
+            if t > start:
+                backward_message = _backward_step(model, backward_message,
+                                                  observation_ids[t])
+
+        for t in range(start, end):
+            belief = _forward_step(model, transposed_transitions, belief,
+                                   observation_ids[t])
+            marginal = belief * segment_backward_messages[t - start]
+            yield marginal / marginal.sum()
+
+
+# -----------------------------------------------------------------------------
+# Learning the model's parameters with Baum-Welch (EM)
+#
+# Expected counts are accumulated directly on the entries of the model's sparse
+# transition and observation matrices, so transitions and observations that
+# the model rules out stay impossible and the learned model keeps its sparsity
+# pattern.
+#
+
+def _expected_counts_block(model, observation_ids, lengths):
+    """
+    E-step for a block of padded observation id sequences.
+
+    Output
+    ------
+    (prior_counts, transition_counts, emission_counts, log_likelihood), where
+    transition_counts and emission_counts are aligned with
+    model.transition_matrix.data and model.observation_matrix.data, and
+    log_likelihood is the total log probability of the sequences
+    """
+    num_sequences, num_time_steps = observation_ids.shape
+    transition_matrix = model.transition_matrix
+    transition_rows = np.repeat(np.arange(model.num_hidden_states),
+                                np.diff(transition_matrix.indptr))
+    transition_columns = transition_matrix.indices
+    emission_indptr, emitting_states, emission_positions = \
+        model.emitting_states()
+
+    forward, log_likelihoods = _forward_block(model, observation_ids)
+    prior_counts = np.zeros(model.num_hidden_states)
+    transition_counts = np.zeros(transition_matrix.nnz)
+    emission_counts = np.zeros(model.observation_matrix.nnz)
+
+    backward = np.ones((model.num_hidden_states, num_sequences))
+    for t in reversed(range(num_time_steps)):
+        if t < num_time_steps - 1:
+            # expected transitions from time step t to t + 1, where weighted
+            # holds the next time step's observation likelihoods times its
+            # backward messages
+            normalizers = (forward[t] *
+                           transition_matrix.dot(weighted)).sum(axis=0)
+            scales = np.divide(1., normalizers,
+                               out=np.zeros(num_sequences),
+                               where=t + 1 < lengths)
+            transition_counts += (forward[t][transition_rows] *
+                                  weighted[transition_columns]).dot(scales)
+
+        gamma = forward[t] * backward
+        gamma /= gamma.sum(axis=0)
+        if t == 0:
+            prior_counts += gamma[:, lengths > 0].sum(axis=1)
+
+        # expected emissions at time step t, for each sequence adding its
+        # marginal probabilities of the hidden states that can emit what was
+        # observed
+        observed = np.flatnonzero((t < lengths) &
+                                  (observation_ids[:, t] >= 0))
+        starts = emission_indptr[observation_ids[observed, t]]
+        counts = emission_indptr[observation_ids[observed, t] + 1] - starts
+        entries = np.arange(counts.sum()) + \
+            np.repeat(starts - np.cumsum(counts) + counts, counts)
+        emission_counts += np.bincount(
+            emission_positions[entries],
+            weights=gamma[emitting_states[entries],
+                          np.repeat(observed, counts)],
+            minlength=len(emission_counts))
+
+        likelihoods = \
+            model.observation_likelihood_columns(observation_ids[:, t])
+        weighted = likelihoods * backward
+        backward = transition_matrix.dot(weighted)
+        backward /= backward.sum(axis=0)
+
+    transition_counts *= transition_matrix.data
+    return (prior_counts, transition_counts, emission_counts,
+            log_likelihoods.sum())
+
+
+def _normalize_rows(matrix, counts):
+    # turns counts aligned with a CSR matrix's entries into probabilities
+    # summing to 1 across each row, keeping the matrix's own probabilities for
+    # rows without any counts
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    totals = np.bincount(rows, weights=counts,
+                         minlength=matrix.shape[0])[rows]
+    return np.where(totals > 0,
+                    np.divide(counts, totals, out=np.zeros(len(counts)),
+                              where=totals > 0),
+                    matrix.data)
+
+
+def baum_welch(observation_sequences, model=None, num_iterations=10,
+               lengths=None, num_workers=None, block_size=256,
+               update_prior=True):
+    """
+    Learns the prior, transition and observation probabilities from
+    observation sequences alone, using the Baum-Welch algorithm.
+
+    Each iteration runs scaled forward-backward on blocks of block_size
+    sequences at a time (in a process pool if num_workers is more than 1)
+    and sums their expected counts, so the log likelihood of the sequences
+    never decreases from one iteration to the next.
+
+    Input
+    -----
+    observation_sequences, lengths: see forward_backward_batch()
+    model: the robot.CompiledModel to start from (defaults to
+        robot.get_compiled_model()); only probabilities that are nonzero in
+        this model can be nonzero in the learned model
+    num_iterations: number of EM iterations
+    num_workers: if more than 1, blocks are processed in a process pool with
+        this many workers
+    block_size: number of sequences per block
+    update_prior: whether to learn the initial distribution too
+
+    Output
+    ------
+    (learned_model, log_likelihoods), where log_likelihoods[i] is the total
+    log probability of the observation sequences under the model used in
+    iteration i
+    """
+    if model is None:
+        model = robot.get_compiled_model()
+    observation_ids, lengths = \
+        _observation_id_batch(observation_sequences, model, lengths)
+    blocks = [np.arange(start, min(start + block_size, len(lengths)))
+              for start in range(0, len(lengths), block_size)]
+
+    executor = None
+    if num_workers is not None and num_workers > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(num_workers)
+    log_likelihoods = []
+    try:
+        for iteration in range(num_iterations):
+            if executor is None:
+                results = [_expected_counts_block(model,
+                                                  observation_ids[block],
+                                                  lengths[block])
+                           for block in blocks]
+            else:
+                futures = [executor.submit(_expected_counts_block, model,
+                                           observation_ids[block],
+                                           lengths[block])
+                           for block in blocks]
+                results = [future.result() for future in futures]
+            prior_counts, transition_counts, emission_counts, \
+                log_likelihood = [sum(totals) for totals in zip(*results)]
+            log_likelihoods.append(log_likelihood)
+
+            prior = None
+            if update_prior:
+                prior = prior_counts / prior_counts.sum()
+            model = model.with_parameters(
+                prior,
+                _normalize_rows(model.transition_matrix, transition_counts),
+                _normalize_rows(model.observation_matrix, emission_counts))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return model, np.array(log_likelihoods)
+
+
 # -----------------------------------------------------------------------------
 # Generating data from the hidden Markov model
 #
 
 def generate_data(num_time_steps, make_some_observations_missing=False,
-                  random_seed=None):
+                  random_seed=None, model=None):
     # generate samples from this project's hidden Markov model
+    if model is None:
+        model = robot.get_compiled_model()
     hidden_states = []
     observations = []
 
@@ -211,8 +1118,8 @@ def generate_data(num_time_steps, make_some_observations_missing=False,
     np.random.seed(random_seed)
 
     # draw initial state and emit an observation
-    initial_state = prior_distribution.sample()
-    initial_observation = observation_model(initial_state).sample()
+    initial_state = model.initial_distribution().sample()
+    initial_observation = model.observation_model(initial_state).sample()
 
     hidden_states.append(initial_state)
     observations.append(initial_observation)
@@ -220,16 +1127,16 @@ def generate_data(num_time_steps, make_some_observations_missing=False,
     for time_step in range(1, num_time_steps):
         # move the robot
         prev_state = hidden_states[-1]
-        new_state = transition_model(prev_state).sample()
+        new_state = model.transition_model(prev_state).sample()
 
         # maybe emit an observation
         if not make_some_observations_missing:
-            new_observation = observation_model(new_state).sample()
+            new_observation = model.observation_model(new_state).sample()
         else:
             if np.random.rand() < .1:  # 0.1 prob. of observation being missing
                 new_observation = None
             else:
-                new_observation = observation_model(new_state).sample()
+                new_observation = model.observation_model(new_state).sample()
 
         hidden_states.append(new_state)
         observations.append(new_observation)
@@ -237,6 +1144,135 @@ def generate_data(num_time_steps, make_some_observations_missing=False,
     return hidden_states, observations
 
 
+# -----------------------------------------------------------------------------
+# Vectorized simulation of many trajectories at once
+#
+
+def _sample_table_rows(rng, cumulative_probs, num_entries, rows):
+    # for each entry of rows, samples a column of the corresponding row of a
+    # padded table (see robot.CompiledModel.successor_table()), given the
+    # table's cumulative probabilities and number of entries per row
+    uniforms = rng.random(len(rows))
+    columns = (uniforms[:, np.newaxis] >= cumulative_probs[rows]).sum(axis=1)
+    return np.minimum(columns, num_entries[rows] - 1)
+
+
+def _simulate_chunks(num_trajectories, num_time_steps, model,
+                     missing_probability, rng, chunk_size):
+    # yields (hidden_state_ids, observation_ids) for chunk_size time steps at
+    # a time, as int arrays of shape (number of time steps in chunk,
+    # num_trajectories)
+    successors, transition_probs = model.successor_table()
+    emissions, emission_probs = model.emission_table()
+    cumulative_transitions = np.cumsum(transition_probs, axis=1)
+    cumulative_emissions = np.cumsum(emission_probs, axis=1)
+    num_successors = np.count_nonzero(transition_probs, axis=1)
+    num_emissions = np.count_nonzero(emission_probs, axis=1)
+    cumulative_prior = np.cumsum(model.prior)
+    trajectories = np.arange(num_trajectories)
+
+    states = None
+    for start in range(0, num_time_steps, chunk_size):
+        end = min(start + chunk_size, num_time_steps)
+        hidden_state_ids = np.empty((end - start, num_trajectories),
+                                    dtype=np.int64)
+        observation_ids = np.empty((end - start, num_trajectories),
+                                   dtype=np.int64)
+        for t in range(start, end):
+            # move the robots
+            if states is None:
+                states = np.minimum(
+                    np.searchsorted(cumulative_prior,
+                                    rng.random(num_trajectories),
+                                    side='right'),
+                    model.num_hidden_states - 1)
+            else:
+                columns = _sample_table_rows(rng, cumulative_transitions,
+                                             num_successors, states)
+                states = successors[states, columns]
+
+            # emit observations, some of which may go missing after the
+            # first time step
+            columns = _sample_table_rows(rng, cumulative_emissions,
+                                         num_emissions, states)
+            observations = emissions[states, columns]
+            if t > 0 and missing_probability > 0:
+                missing = rng.random(num_trajectories) < missing_probability
+                observations[missing] = -1
+
+            hidden_state_ids[t - start] = states
+            observation_ids[t - start] = observations
+        yield hidden_state_ids, observation_ids
+
+
+def simulate_trajectories(num_trajectories, num_time_steps, model=None,
+                          missing_probability=0., random_seed=None,
+                          chunk_size=4096):
+    """
+    Same model as generate_data(), but simulating many trajectories at once:
+    all trajectories advance together one time step at a time, sampling from
+    the model's padded successor and emission tables (see
+    robot.CompiledModel) with a numpy.random.Generator.
+
+    Input
+    -----
+    num_trajectories: number of trajectories B
+    num_time_steps: number of time steps T per trajectory
+    model: the robot.CompiledModel to use (defaults to
+        robot.get_compiled_model())
+    missing_probability: probability of each observation after the first time
+        step being missing (generate_data() uses .1)
+    random_seed: seed for numpy.random.default_rng(), or a
+        numpy.random.Generator
+    chunk_size: number of time steps simulated between yields of the
+        underlying generator
+
+    Output
+    ------
+    (hidden_state_ids, observation_ids), two int arrays of shape (T, B) where
+    a missing observation is encoded as -1
+    """
+    if model is None:
+        model = robot.get_compiled_model()
+    rng = np.random.default_rng(random_seed)
+    chunks = list(_simulate_chunks(num_trajectories, num_time_steps, model,
+                                   missing_probability, rng, chunk_size))
+    if len(chunks) == 0:
+        empty = np.zeros((0, num_trajectories), dtype=np.int64)
+        return empty, empty.copy()
+    hidden_state_chunks, observation_chunks = zip(*chunks)
+    return np.concatenate(hidden_state_chunks), \
+        np.concatenate(observation_chunks)
+
+
+def simulate_trajectories_to_file(filename, num_trajectories, num_time_steps,
+                                  model=None, missing_probability=0.,
+                                  random_seed=None, chunk_size=4096):
+    """
+    Same as simulate_trajectories() but streaming the trajectories to a
+    trajectory file (see robot.TrajectoryWriter) chunk_size time steps at a
+    time instead of returning them, so only one chunk is ever held in memory.
+
+    Input
+    -----
+    filename: trajectory file to write
+    model: the robot.GridWorld to use (defaults to
+        robot.get_compiled_model())
+    num_trajectories, num_time_steps, missing_probability, random_seed,
+        chunk_size: see simulate_trajectories()
+    """
+    if model is None:
+        model = robot.get_compiled_model()
+    rng = np.random.default_rng(random_seed)
+    with robot.TrajectoryWriter(filename, model,
+                                num_trajectories) as writer:
+        for hidden_state_ids, observation_ids in \
+                _simulate_chunks(num_trajectories, num_time_steps,
+                                 model, missing_probability, rng,
+                                 chunk_size):
+            writer.append(hidden_state_ids, observation_ids)
+
+
 # -----------------------------------------------------------------------------
 # Main
 #
@@ -246,6 +1282,9 @@ def main():
     make_some_observations_missing = False
     use_graphics = True
     need_to_generate_data = True
+    grid_width = robot.GRID_WIDTH
+    grid_height = robot.GRID_HEIGHT
+    sensor_radius = 1
 
     # parse command line arguments
     for arg in sys.argv[1:]:
@@ -253,21 +1292,31 @@ def main():
             make_some_observations_missing = True
         elif arg == '--nographics':
             use_graphics = False
+        elif arg.startswith('--width='):
+            grid_width = int(arg[8:])
+        elif arg.startswith('--height='):
+            grid_height = int(arg[9:])
+        elif arg.startswith('--sensor-radius='):
+            sensor_radius = int(arg[16:])
         elif arg.startswith('--load='):
             filename = arg[7:]
             hidden_states, observations = robot.load_data(filename)
             need_to_generate_data = False
             num_time_steps = len(hidden_states)
 
+    model = robot.GridWorld(grid_width, grid_height, sensor_radius)
+
     # if no data is loaded, then generate new data
     if need_to_generate_data:
         num_time_steps = 100
         hidden_states, observations = \
             generate_data(num_time_steps,
-                          make_some_observations_missing)
+                          make_some_observations_missing,
+                          model=model)
 
     print('Running forward-backward...')
-    marginals = forward_backward(observations)
+    marginals, _ = forward_backward_scaled(observations, model)
+    marginals = array_distributions(marginals, model)
     print("\n")
 
     timestep = 99
@@ -281,7 +1330,7 @@ def main():
     print("\n")
 
     print('Running Viterbi...')
-    estimated_states = Viterbi(observations)
+    estimated_states = Viterbi_vectorized(observations, model)
     print("\n")
 
     print("Last 10 hidden states in the MAP estimate:")
@@ -293,7 +1342,7 @@ def main():
     print("\n")
 
     print('Finding second-best MAP estimate...')
-    estimated_states2 = second_best(observations)
+    estimated_states2 = second_best(observations, model)
     print("\n")
 
     print("Last 10 hidden states in the second-best MAP estimate:")
@@ -351,7 +1400,8 @@ def main():
         app = graphics.playback_positions(hidden_states,
                                           observations,
                                           estimated_states,
-                                          marginals)
+                                          marginals,
+                                          grid_world=model)
         app.mainloop()
 
 
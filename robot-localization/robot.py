@@ -1,6 +1,11 @@
 # robot.py
 # Coded by George H. Chen (georgehc@mit.edu) -- updated 10/18/2018
+import abc
+import copy
+import struct
+
 import numpy as np
+import scipy.sparse
 
 
 # -----------------------------------------------------------------------------
@@ -88,6 +93,124 @@ class Distribution(dict):
         return keys[rand_idx]
 
 
+class SupportIndex(object):
+    """
+    An immutable, ordered set of keys, each with a position 0, 1, 2, ..., that
+    ArrayDistributions over the same keys share.
+
+    Methods
+    -------
+    key(position):
+      returns the key at the given position
+    position(key):
+      returns the position of the given key (KeyError if there is none)
+    """
+    __slots__ = ('_keys', '_positions')
+
+    def __init__(self, keys):
+        self._keys = tuple(keys)
+        self._positions = {key: i for i, key in enumerate(self._keys)}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def key(self, position):
+        return self._keys[position]
+
+    def position(self, key):
+        return self._positions[key]
+
+
+class ArrayDistribution(object):
+    """
+    Same dict-like API as the Distribution class, but backed by a float64
+    vector `probs` whose i-th entry is the probability of the i-th key of a
+    shared SupportIndex `support`. Only keys with nonzero probability count
+    as stored, so keys(), items(), len() and `in` skip the rest of the
+    support, and setting a key outside of the support raises a KeyError.
+
+    Methods
+    -------
+    renormalize(), get_mode(), sample():
+      same as for Distribution (get_mode() breaks ties in favor of the
+      earliest key in the support)
+    log():
+      returns the vector of log probabilities
+    multiply(other):
+      returns a new ArrayDistribution whose probabilities are the products of
+      this one's and those of another ArrayDistribution over the same support
+      (or of a vector); the result is not renormalized
+    copy():
+      returns a new ArrayDistribution with a copy of the probabilities
+    """
+    __slots__ = ('support', 'probs')
+
+    def __init__(self, support, probs=None):
+        self.support = support
+        if probs is None:
+            self.probs = np.zeros(len(support))
+        else:
+            self.probs = np.asarray(probs, dtype=np.float64)
+
+    def __getitem__(self, key):
+        try:
+            return self.probs[self.support.position(key)]
+        except KeyError:
+            # if the key is missing, return probability 0
+            return 0
+
+    def __setitem__(self, key, prob):
+        self.probs[self.support.position(key)] = prob
+
+    def __contains__(self, key):
+        return self[key] != 0
+
+    def __len__(self):
+        return int(np.count_nonzero(self.probs))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __repr__(self):
+        return 'ArrayDistribution(%r)' % dict(self.items())
+
+    def keys(self):
+        return [self.support.key(i) for i in np.flatnonzero(self.probs)]
+
+    def values(self):
+        return self.probs[self.probs != 0].tolist()
+
+    def items(self):
+        return list(zip(self.keys(), self.values()))
+
+    def renormalize(self):
+        self.probs /= self.probs.sum()
+
+    def get_mode(self):
+        return self.support.key(int(np.argmax(self.probs)))
+
+    def sample(self):
+        cumulative_probs = np.cumsum(self.probs)
+        rand_idx = np.searchsorted(cumulative_probs,
+                                   np.random.rand() * cumulative_probs[-1],
+                                   side='right')
+        return self.support.key(min(int(rand_idx), len(self.probs) - 1))
+
+    def log(self):
+        with np.errstate(divide='ignore'):
+            return np.log(self.probs)
+
+    def multiply(self, other):
+        if isinstance(other, ArrayDistribution):
+            if other.support is not self.support:
+                raise ValueError('distributions have different supports')
+            other = other.probs
+        return ArrayDistribution(self.support, self.probs * other)
+
+    def copy(self):
+        return ArrayDistribution(self.support, self.probs.copy())
+
+
 # -----------------------------------------------------------------------------
 # Functions specifying the robot model (e.g., listing all possible hidden and
 # observed states, initial distribution, transition model, observation model)
@@ -185,6 +308,438 @@ def observation_model(state):
     return observed_states
 
 
+# -----------------------------------------------------------------------------
+# Compiled models: hidden and observed states replaced by integer ids, and the
+# transition and observation models stored as sparse matrices
+#
+
+ACTIONS = ('left', 'right', 'up', 'down', 'stay')
+
+
+def _padded_rows(matrix):
+    # returns (columns, values), two 2D arrays with one row per row of the
+    # given CSR matrix listing its nonzero entries in order, padded with
+    # column 0 at value 0
+    matrix = matrix.copy()
+    matrix.eliminate_zeros()
+    row_lengths = np.diff(matrix.indptr)
+    width = max(int(row_lengths.max(initial=0)), 1)
+    rows = np.repeat(np.arange(matrix.shape[0]), row_lengths)
+    positions = np.arange(matrix.nnz) - np.repeat(matrix.indptr[:-1],
+                                                  row_lengths)
+    columns = np.zeros((matrix.shape[0], width), dtype=np.int64)
+    values = np.zeros((matrix.shape[0], width))
+    columns[rows, positions] = matrix.indices
+    values[rows, positions] = matrix.data
+    return columns, values
+
+
+class CompiledModel(abc.ABC):
+    """
+    A hidden Markov model in which every hidden state and every observed state
+    has a stable integer id, and the transition and observation models are
+    stored as sparse matrices. Subclasses say how ids map to states by
+    implementing the four abstract id conversion methods (see GridWorld
+    below).
+
+    Attributes
+    ----------
+    prior: 1D array where prior[i] is the probability of initial state i
+    transition_matrix: CSR matrix where transition_matrix[i, j] is the
+      probability of going from hidden state i to hidden state j
+    observation_matrix: CSR matrix where observation_matrix[i, o] is the
+      probability of hidden state i emitting observed state o
+
+    Methods
+    -------
+    initial_distribution(), transition_model(state), observation_model(state):
+      same as the functions of the same name in this module, except that the
+      Distributions returned are cached and shared (do not modify them!)
+    hidden_state(i), hidden_state_id(state):
+      convert between hidden state ids and hidden states
+    observed_state(o), observed_state_id(state):
+      convert between observed state ids and observed states
+    """
+
+    def __init__(self, prior, transition_matrix, observation_matrix):
+        self.prior = np.asarray(prior, dtype=np.float64)
+        self.transition_matrix = scipy.sparse.csr_matrix(transition_matrix)
+        self.observation_matrix = scipy.sparse.csr_matrix(observation_matrix)
+        self._observation_matrix_csc = self.observation_matrix.tocsc()
+        self._initial_distribution = None
+        self._transition_views = {}
+        self._observation_views = {}
+        self._predecessor_table = None
+        self._successor_table = None
+        self._emission_table = None
+        self._hidden_support = None
+        self._emitting_states = None
+
+    @property
+    def num_hidden_states(self):
+        return self.transition_matrix.shape[0]
+
+    @property
+    def num_observed_states(self):
+        return self.observation_matrix.shape[1]
+
+    @property
+    def hidden_support(self):
+        # the SupportIndex of hidden states by id, for ArrayDistributions
+        if self._hidden_support is None:
+            self._hidden_support = _CompiledModelSupport(self)
+        return self._hidden_support
+
+    @property
+    def hidden_states(self):
+        # lists all possible hidden states, ordered by id
+        return [self.hidden_state(i) for i in range(self.num_hidden_states)]
+
+    @abc.abstractmethod
+    def hidden_state(self, hidden_state_id):
+        """Returns the hidden state with the given id."""
+
+    @abc.abstractmethod
+    def hidden_state_id(self, state):
+        """Returns the id of a hidden state, in range(num_hidden_states)."""
+
+    @abc.abstractmethod
+    def observed_state(self, observed_state_id):
+        """Returns the observed state with the given id."""
+
+    @abc.abstractmethod
+    def observed_state_id(self, state):
+        """Returns the id of an observed state, in range(num_observed_states)."""
+
+    def _row_view(self, matrix, i, key):
+        # builds a Distribution from row i of a CSR matrix
+        start, end = matrix.indptr[i], matrix.indptr[i + 1]
+        view = Distribution()
+        for j, prob in zip(matrix.indices[start:end].tolist(),
+                           matrix.data[start:end].tolist()):
+            view[key(j)] = prob
+        return view
+
+    def initial_distribution(self):
+        if self._initial_distribution is None:
+            self._initial_distribution = Distribution()
+            for i in np.flatnonzero(self.prior).tolist():
+                self._initial_distribution[self.hidden_state(i)] = \
+                    float(self.prior[i])
+        return self._initial_distribution
+
+    def transition_model(self, state):
+        i = self.hidden_state_id(state)
+        if i not in self._transition_views:
+            self._transition_views[i] = \
+                self._row_view(self.transition_matrix, i, self.hidden_state)
+        return self._transition_views[i]
+
+    def observation_model(self, state):
+        i = self.hidden_state_id(state)
+        if i not in self._observation_views:
+            self._observation_views[i] = \
+                self._row_view(self.observation_matrix, i,
+                               self.observed_state)
+        return self._observation_views[i]
+
+    def observation_likelihoods(self, observation_id):
+        # returns a 1D array whose i-th entry is the probability of hidden
+        # state i emitting the observed state with the given id
+        csc = self._observation_matrix_csc
+        start, end = csc.indptr[observation_id], csc.indptr[observation_id + 1]
+        likelihoods = np.zeros(self.num_hidden_states)
+        likelihoods[csc.indices[start:end]] = csc.data[start:end]
+        return likelihoods
+
+    def observation_likelihood_columns(self, observation_ids):
+        # returns a 2D array whose b-th column is
+        # observation_likelihoods(observation_ids[b]), or all 1's if
+        # observation_ids[b] is -1 (a missing observation)
+        observation_ids = np.asarray(observation_ids)
+        columns = self._observation_matrix_csc[
+            :, np.maximum(observation_ids, 0)].toarray()
+        columns[:, observation_ids < 0] = 1.
+        return columns
+
+    def log_observation_likelihood_columns(self, observation_ids):
+        # same as the log of observation_likelihood_columns(), but only taking
+        # logs of the nonzero likelihoods
+        observation_ids = np.asarray(observation_ids)
+        entries = self._observation_matrix_csc[
+            :, np.maximum(observation_ids, 0)].tocoo()
+        columns = np.full((self.num_hidden_states, len(observation_ids)),
+                          -np.inf)
+        with np.errstate(divide='ignore'):
+            columns[entries.row, entries.col] = np.log(entries.data)
+        columns[:, observation_ids < 0] = 0.
+        return columns
+
+    def predecessor_table(self):
+        # returns (predecessors, probs), two 2D arrays with one row per hidden
+        # state j: predecessors[j, k] is the k-th hidden state that can
+        # transition into j and probs[j, k] is the probability it does so;
+        # rows are padded with state 0 at probability 0
+        if self._predecessor_table is None:
+            self._predecessor_table = \
+                _padded_rows(self.transition_matrix.T.tocsr())
+        return self._predecessor_table
+
+    def successor_table(self):
+        # same as predecessor_table() but listing, for each hidden state i,
+        # the hidden states that i can transition into
+        if self._successor_table is None:
+            self._successor_table = _padded_rows(self.transition_matrix)
+        return self._successor_table
+
+    def emission_table(self):
+        # same as successor_table() but listing, for each hidden state i, the
+        # observed states that i can emit
+        if self._emission_table is None:
+            self._emission_table = _padded_rows(self.observation_matrix)
+        return self._emission_table
+
+    def emitting_states(self):
+        # returns (indptr, hidden_state_ids, positions), listing for each
+        # observed state o the hidden states that can emit it,
+        # hidden_state_ids[indptr[o]:indptr[o + 1]], along with the positions
+        # of the corresponding entries in observation_matrix.data
+        if self._emitting_states is None:
+            matrix = self.observation_matrix
+            positions = scipy.sparse.csr_matrix(
+                (np.arange(1, matrix.nnz + 1), matrix.indices,
+                 matrix.indptr), shape=matrix.shape).tocsc()
+            self._emitting_states = (positions.indptr, positions.indices,
+                                     positions.data - 1)
+        return self._emitting_states
+
+    def with_parameters(self, prior=None, transition_probs=None,
+                        observation_probs=None):
+        # returns a copy of this model with new parameters but the same
+        # states and the same sparsity pattern: transition_probs and
+        # observation_probs replace transition_matrix.data and
+        # observation_matrix.data, respectively
+        model = copy.copy(self)
+        transition_matrix = self.transition_matrix.copy()
+        if transition_probs is not None:
+            transition_matrix.data = np.array(transition_probs,
+                                              dtype=np.float64)
+        observation_matrix = self.observation_matrix.copy()
+        if observation_probs is not None:
+            observation_matrix.data = np.array(observation_probs,
+                                               dtype=np.float64)
+        CompiledModel.__init__(model,
+                               self.prior if prior is None else prior,
+                               transition_matrix, observation_matrix)
+        return model
+
+    def hidden_state_ids(self, hidden_states):
+        # converts a list of hidden states to a 1D array of hidden state ids
+        return np.array([self.hidden_state_id(state)
+                         for state in hidden_states], dtype=np.int64)
+
+    def observation_ids(self, observations):
+        # converts a list of observations to a 1D array of observed state ids,
+        # with -1 standing in for a missing observation
+        return np.array([-1 if observation is None
+                         else self.observed_state_id(observation)
+                         for observation in observations], dtype=np.int64)
+
+
+class _CompiledModelSupport(SupportIndex):
+    # a SupportIndex of a CompiledModel's hidden states, without building the
+    # list of all of them
+    __slots__ = ('_model',)
+
+    def __init__(self, model):
+        self._model = model
+
+    def __len__(self):
+        return self._model.num_hidden_states
+
+    def key(self, position):
+        return self._model.hidden_state(position)
+
+    def position(self, key):
+        return self._model.hidden_state_id(key)
+
+
+class GridWorld(CompiledModel):
+    """
+    The robot model of this module on a grid of any size: the functions
+    get_all_hidden_states(), initial_distribution(), transition_model() and
+    observation_model() above describe GridWorld(GRID_WIDTH, GRID_HEIGHT).
+
+    Hidden state ids follow the order of get_all_hidden_states() and observed
+    state ids follow the order of get_all_observed_states(). The sparse
+    matrices are built with NumPy directly rather than by calling the model
+    functions per state, and every hidden state has at most 5 possible next
+    states, so memory grows linearly with the number of hidden states even for
+    grids with millions of them.
+
+    Inputs
+    ------
+    - width, height: grid dimensions
+    - sensor_radius: the robot's observed position is uniformly distributed
+      over the cells within this (Euclidean) distance of its true position
+    """
+
+    def __init__(self, width, height, sensor_radius=1):
+        self.width = width
+        self.height = height
+        self.sensor_radius = sensor_radius
+
+        # enumerate (x, y, action) in the order of get_all_hidden_states(),
+        # where cell_ids[i] = x * height + y
+        xs, ys, actions = np.meshgrid(np.arange(width), np.arange(height),
+                                      np.arange(len(ACTIONS)), indexing='ij')
+        valid = ~(((actions == ACTIONS.index('right')) & (xs == 0)) |
+                  ((actions == ACTIONS.index('left')) & (xs == width - 1)) |
+                  ((actions == ACTIONS.index('down')) & (ys == 0)) |
+                  ((actions == ACTIONS.index('up')) & (ys == height - 1)))
+        self._state_index = np.full(valid.shape, -1, dtype=np.int64)
+        self._state_index[valid] = np.arange(np.count_nonzero(valid))
+        self.state_xs = xs[valid]
+        self.state_ys = ys[valid]
+        self.state_actions = actions[valid]
+        num_hidden_states = len(self.state_xs)
+
+        prior = np.where(self.state_actions == ACTIONS.index('stay'),
+                         1. / (width * height), 0.)
+
+        super(GridWorld, self).__init__(prior,
+                                        self._build_transition_matrix(),
+                                        self._build_observation_matrix())
+        assert self.num_hidden_states == num_hidden_states
+        self._position_aggregator = None
+
+    def _csr_from_candidates(self, targets, weights, num_columns):
+        # builds a row-normalized CSR matrix from per-row candidate entries
+        # (one column of `targets`/`weights` per candidate, with weight 0 for
+        # candidates that are not possible), keeping the candidates' order
+        weights = weights / weights.sum(axis=1, keepdims=True)
+        mask = weights > 0
+        indptr = np.zeros(len(targets) + 1, dtype=np.int64)
+        np.cumsum(mask.sum(axis=1), out=indptr[1:])
+        return scipy.sparse.csr_matrix(
+            (weights[mask], targets[mask], indptr),
+            shape=(len(targets), num_columns))
+
+    def _build_transition_matrix(self):
+        # same as transition_model(): staying has weight .2 after a 'stay' and
+        # .1 otherwise; after a 'stay', each possible move has weight .2, and
+        # after a move, repeating it (if possible) has weight .9
+        xs, ys, actions = self.state_xs, self.state_ys, self.state_actions
+        stayed = actions == ACTIONS.index('stay')
+
+        # candidates in the order stay, up, down, left, right
+        moves = [('stay', 0, 0, np.ones_like(stayed)),
+                 ('up', 0, -1, ys > 0),
+                 ('down', 0, 1, ys < self.height - 1),
+                 ('left', -1, 0, xs > 0),
+                 ('right', 1, 0, xs < self.width - 1)]
+        targets = np.zeros((len(xs), len(moves)), dtype=np.int64)
+        weights = np.zeros((len(xs), len(moves)))
+        for k, (move, dx, dy, possible) in enumerate(moves):
+            action = ACTIONS.index(move)
+            if move == 'stay':
+                weights[:, k] = np.where(stayed, .2, .1)
+            else:
+                repeated = possible & (actions == action)
+                weights[:, k] = np.where(possible & stayed, .2, 0.) + \
+                    np.where(repeated, .9, 0.)
+            targets[possible, k] = self._state_index[
+                xs[possible] + dx, ys[possible] + dy, action]
+        return self._csr_from_candidates(targets, weights,
+                                         len(self.state_xs))
+
+    def _build_observation_matrix(self):
+        # same as observation_model(): uniform over the cells within
+        # sensor_radius of the true position, in the order of
+        # get_all_observed_states()
+        radius = self.sensor_radius
+        offsets = [(dx, dy)
+                   for dx in range(-radius, radius + 1)
+                   for dy in range(-radius, radius + 1)
+                   if dx**2 + dy**2 <= radius**2]
+        xs, ys = self.state_xs, self.state_ys
+        targets = np.zeros((len(xs), len(offsets)), dtype=np.int64)
+        weights = np.zeros((len(xs), len(offsets)))
+        for k, (dx, dy) in enumerate(offsets):
+            inside = (xs + dx >= 0) & (xs + dx < self.width) & \
+                (ys + dy >= 0) & (ys + dy < self.height)
+            targets[inside, k] = (xs[inside] + dx) * self.height + \
+                ys[inside] + dy
+            weights[inside, k] = 1.
+        return self._csr_from_candidates(targets, weights,
+                                         self.width * self.height)
+
+    def hidden_state(self, hidden_state_id):
+        return (int(self.state_xs[hidden_state_id]),
+                int(self.state_ys[hidden_state_id]),
+                ACTIONS[self.state_actions[hidden_state_id]])
+
+    def hidden_state_id(self, state):
+        x, y, action = state
+        if not (0 <= x < self.width and 0 <= y < self.height) or \
+                self._state_index[x, y, ACTIONS.index(action)] < 0:
+            raise KeyError(state)
+        return int(self._state_index[x, y, ACTIONS.index(action)])
+
+    def hidden_state_ids(self, hidden_states):
+        if len(hidden_states) == 0:
+            return np.zeros(0, dtype=np.int64)
+        xs, ys, actions = zip(*hidden_states)
+        xs = np.array(xs)
+        ys = np.array(ys)
+        actions = np.array([ACTIONS.index(action) for action in actions])
+        if np.any((xs < 0) | (xs >= self.width) |
+                  (ys < 0) | (ys >= self.height)):
+            raise KeyError('hidden state outside of the grid')
+        ids = self._state_index[xs, ys, actions]
+        if np.any(ids < 0):
+            raise KeyError('impossible hidden state')
+        return ids
+
+    def observed_state(self, observed_state_id):
+        return divmod(int(observed_state_id), self.height)
+
+    def position_marginals(self, probs):
+        # sums out the action: given a 1D array indexed by hidden state id
+        # (or a 2D array with one such row per time step), returns a 2D array
+        # indexed by (x, y) (or a 3D array indexed by (row, x, y))
+        if self._position_aggregator is None:
+            self._position_aggregator = scipy.sparse.csr_matrix(
+                (np.ones(self.num_hidden_states),
+                 (self.state_xs * self.height + self.state_ys,
+                  np.arange(self.num_hidden_states))),
+                shape=(self.width * self.height, self.num_hidden_states))
+        probs = np.asarray(probs)
+        positions = self._position_aggregator.dot(probs.T).T
+        return positions.reshape(probs.shape[:-1] +
+                                 (self.width, self.height))
+
+    def observed_state_id(self, state):
+        x, y = state
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            raise KeyError(state)
+        return x * self.height + y
+
+
+_default_grid_world = None
+
+
+def get_compiled_model():
+    # returns GridWorld(GRID_WIDTH, GRID_HEIGHT), which is only rebuilt when
+    # either of them has changed
+    global _default_grid_world
+    if _default_grid_world is None or \
+            (_default_grid_world.width, _default_grid_world.height) != \
+            (GRID_WIDTH, GRID_HEIGHT):
+        _default_grid_world = GridWorld(GRID_WIDTH, GRID_HEIGHT)
+    return _default_grid_world
+
+
 # -----------------------------------------------------------------------------
 # Saving and loading lists of hidden states and observations
 #
@@ -254,9 +809,8 @@ def load_hidden_states(filename):
 
     hidden_states = []
     for line in f.readlines():
-        line = line.strip()
-        if len(line) == 3:
-            parts = line.split()
+        parts = line.split()
+        if len(parts) == 3:
             x = int(parts[0])
             y = int(parts[1])
             action = parts[2]
@@ -285,14 +839,174 @@ def load_observations(filename):
 
     observations = []
     for line in f.readlines():
-        line = line.strip()
-        if len(line) == 1 and line == 'missing':
+        parts = line.split()
+        if parts == ['missing']:
             observations.append(None)
-        elif len(line) == 2:
-            parts = line.split()
+        elif len(parts) == 2:
             x = int(parts[0])
             y = int(parts[1])
             observations.append((x, y))
 
     f.close()
     return observations
+
+
+# -----------------------------------------------------------------------------
+# Binary trajectory format
+#
+# A trajectory file holds B trajectories of T time steps on a GridWorld of a
+# given width and height. After a fixed-size header, the data is a
+# little-endian int32 array of shape (T, B, 2), where [t, b, 0] is the hidden
+# state id and [t, b, 1] is the observed state id (-1 if missing) of the b-th
+# trajectory at time step t. Storing time steps outermost lets trajectories be
+# appended to one chunk of time steps at a time.
+#
+
+TRAJECTORY_MAGIC = b'ROBOTRAJ'
+TRAJECTORY_VERSION = 1
+TRAJECTORY_HEADER = struct.Struct('<8s5q')
+TRAJECTORY_DTYPE = np.dtype('<i4')
+
+
+class TrajectoryWriter(object):
+    """
+    Writes a trajectory file, one chunk of time steps at a time; the number of
+    time steps in the header is filled in by close(). Can be used as a context
+    manager:
+
+    with TrajectoryWriter('fleet.traj', grid_world, 100) as writer:
+        writer.append(hidden_state_ids, observation_ids)
+
+    Inputs
+    ------
+    - filename: file to write
+    - grid_world: the GridWorld whose state ids are being written
+    - num_trajectories: number of trajectories B
+
+    Methods
+    -------
+    append(hidden_state_ids, observation_ids):
+      appends the next time steps, given as two int arrays of shape
+      (number of time steps, B) (or 1D arrays if B is 1)
+    close():
+      finishes writing the file
+    """
+
+    def __init__(self, filename, grid_world, num_trajectories=1):
+        self.width = grid_world.width
+        self.height = grid_world.height
+        self.num_trajectories = num_trajectories
+        self.num_time_steps = 0
+        self._file = open(filename, 'wb')
+        self._write_header()
+
+    def _write_header(self):
+        self._file.seek(0)
+        self._file.write(TRAJECTORY_HEADER.pack(
+            TRAJECTORY_MAGIC, TRAJECTORY_VERSION, self.width, self.height,
+            self.num_trajectories, self.num_time_steps))
+
+    def append(self, hidden_state_ids, observation_ids):
+        chunk = np.stack([np.asarray(hidden_state_ids, dtype=np.int64),
+                          np.asarray(observation_ids, dtype=np.int64)],
+                         axis=-1)
+        chunk = chunk.reshape(-1, self.num_trajectories, 2)
+        chunk.astype(TRAJECTORY_DTYPE).tofile(self._file)
+        self.num_time_steps += len(chunk)
+
+    def close(self):
+        self._write_header()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _read_trajectory_header(filename):
+    with open(filename, 'rb') as f:
+        header = f.read(TRAJECTORY_HEADER.size)
+    if len(header) < TRAJECTORY_HEADER.size:
+        raise ValueError('%s is not a trajectory file' % filename)
+    magic, version, width, height, num_trajectories, num_time_steps = \
+        TRAJECTORY_HEADER.unpack(header)
+    if magic != TRAJECTORY_MAGIC or version != TRAJECTORY_VERSION:
+        raise ValueError('%s is not a trajectory file' % filename)
+    return width, height, num_trajectories, num_time_steps
+
+
+def _map_trajectory_data(filename):
+    # returns the (T, B, 2) data array of a trajectory file, memory-mapped
+    # read-only, along with the grid width and height
+    width, height, num_trajectories, num_time_steps = \
+        _read_trajectory_header(filename)
+    shape = (num_time_steps, num_trajectories, 2)
+    if num_time_steps * num_trajectories == 0:
+        data = np.zeros(shape, dtype=TRAJECTORY_DTYPE)
+    else:
+        data = np.memmap(filename, dtype=TRAJECTORY_DTYPE, mode='r',
+                         offset=TRAJECTORY_HEADER.size, shape=shape)
+    return data, width, height
+
+
+def save_trajectory(filename, hidden_states, observations, grid_world=None):
+    # saves a list of hidden states and observations (as accepted by
+    # save_data()) as a trajectory file with one trajectory
+    if grid_world is None:
+        grid_world = get_compiled_model()
+    assert len(hidden_states) == len(observations)
+    with TrajectoryWriter(filename, grid_world) as writer:
+        writer.append(grid_world.hidden_state_ids(hidden_states),
+                      grid_world.observation_ids(observations))
+
+
+def load_trajectories(filename):
+    # loads a trajectory file without reading it into memory, returning
+    # (hidden_state_ids, observation_ids, (width, height)), where the first
+    # two are read-only memory-mapped int arrays of shape (T, B)
+    data, width, height = _map_trajectory_data(filename)
+    return data[:, :, 0], data[:, :, 1], (width, height)
+
+
+def iter_trajectory_chunks(filename, chunk_size=65536):
+    # loads a trajectory file chunk_size time steps at a time, yielding
+    # (hidden_state_ids, observation_ids) as int arrays of shape
+    # (number of time steps in the chunk, B)
+    data, _, _ = _map_trajectory_data(filename)
+    for start in range(0, len(data), chunk_size):
+        chunk = np.array(data[start:start + chunk_size], dtype=np.int64)
+        yield chunk[:, :, 0], chunk[:, :, 1]
+
+
+def convert_data_to_trajectory(data_filename, trajectory_filename,
+                               grid_world=None, chunk_size=65536):
+    # converts a text file saved by save_data() (such as test.txt or
+    # test_missing.txt) to a trajectory file with one trajectory, without
+    # holding the whole text file in memory
+    if grid_world is None:
+        grid_world = get_compiled_model()
+
+    with open(data_filename, 'r') as f, \
+            TrajectoryWriter(trajectory_filename, grid_world) as writer:
+        hidden_states = []
+        observations = []
+        for line in f:
+            parts = line.split()
+            if len(parts) < 4:
+                continue
+            hidden_states.append((int(parts[0]), int(parts[1]), parts[2]))
+            if parts[3] == 'missing':
+                observations.append(None)
+            else:
+                observations.append((int(parts[3]), int(parts[4])))
+
+            if len(hidden_states) == chunk_size:
+                writer.append(grid_world.hidden_state_ids(hidden_states),
+                              grid_world.observation_ids(observations))
+                hidden_states = []
+                observations = []
+        if len(hidden_states) > 0:
+            writer.append(grid_world.hidden_state_ids(hidden_states),
+                          grid_world.observation_ids(observations))